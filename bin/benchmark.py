@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Times the FeenICS steps on synthetic studies of several sizes, and checks that their classifications have not changed.
+
+Usage:
+    benchmark.py [options] <workdir>
+
+Arguments:
+    <workdir>           folder for the synthetic studies (one per size, generated by synthetic_study.py and reused on later runs) and their cleaned images
+
+Options:
+    --sizes             comma separated XxYxZxCOMPS study sizes. Default is 64x64x20x30,64x64x40x100
+    --subjects          number of subjects per study. Default is 2
+    --volumes           number of volumes per run. Default is 100
+    --repeat            number of times check_slices.main is timed on one run; the fastest is reported. Default is 3
+    --backend           s3 regression backend, fsl or numpy (default, does not need FSL)
+    --golden            JSON file of expected classifications. Default is benchmark_golden.json next to this script, recorded with the reference (fftpack) fft
+    --updateGolden      (re)write the --golden file from this run instead of comparing against it. Needs the reference fft settings
+    --json              also write the timings to this JSON file
+
+For each size, times check_slices.main on the first run, s2_identify_components.main over the study (recomputing every run)
+and s3_remove_flagged_components.main, and reports how many of the flagged components are the ones given artifact.
+The golden file records the flagged components and the SHA-1 of the classification file of each run, so any change in the
+thresholds or counts is caught, not only changes in the flags. Its studies are keyed by size, subjects and volumes; the
+synthetic studies are seeded, so the same study is generated everywhere. Studies it does not list are reported as
+unchecked. Exits with status 1 if a classification differs.
+"""
+
+import argparse
+import contextlib
+import json
+import os, sys, time
+import check_slices
+import result_cache
+import s2_identify_components
+import s3_remove_flagged_components
+import synthetic_study
+
+parser = argparse.ArgumentParser(description="Time FeenICS on synthetic studies and check classifications against golden outputs")
+parser.add_argument("--sizes", default="64x64x20x30,64x64x40x100", help="comma separated XxYxZxCOMPS study sizes. Default is 64x64x20x30,64x64x40x100.")
+parser.add_argument("--subjects", type=int, default=2, help="number of subjects per study. Default is 2.")
+parser.add_argument("--volumes", type=int, default=100, help="number of volumes per run. Default is 100.")
+parser.add_argument("--repeat", type=int, default=3, help="number of times check_slices.main is timed; the fastest is reported. Default is 3.")
+parser.add_argument("--backend", choices=['fsl', 'numpy'], default='numpy', help="s3 regression backend. Default is numpy.")
+parser.add_argument("--golden", default=None, help="JSON file of expected classifications. Default is benchmark_golden.json next to this script.")
+parser.add_argument("--updateGolden", action='store_true', help="(re)write the --golden file from this run instead of comparing against it")
+parser.add_argument("--json", help="also write the timings to this JSON file")
+parser.add_argument("workdir", type=str, help="folder for the synthetic studies")
+
+CSV_NAME = 'fix4melview_Standard_thr20.txt'
+
+# classifications of the default studies, recorded with the reference fft settings
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_golden.json')
+
+# silence the per run messages of the steps being timed
+@contextlib.contextmanager
+def quiet():
+
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+# wall time of calling function(*args)
+def timed(function, *args, **kwargs):
+
+    start = time.time()
+    function(*args, **kwargs)
+    return(time.time() - start)
+
+# name of the synthetic study of one size, also its key in golden files
+def study_name(size, subjects, volumes):
+    return('{}_{}s_{}v'.format(size, subjects, volumes))
+
+# the synthetic study of one size, generated the first time it is needed
+def study(workdir, size, subjects, volumes):
+
+    directory = os.path.join(workdir, 'synthetic_' + study_name(size, subjects, volumes))
+    if not os.path.exists(os.path.join(directory, 'feenics_synthetic.csv')):
+        x, y, z, comps = [int(n) for n in size.split('x')]
+        print("Generating {}".format(directory))
+        synthetic_study.main(directory, subjects, (x, y, z), comps, volumes)
+
+    return(directory)
+
+# {run: [flagged components]} for the components given artifact in a synthetic study
+def truth(directory):
+
+    runs = {}
+    with open(os.path.join(directory, 'feenics_synthetic.csv')) as f:
+        for line in f.readlines()[1:]:
+            i, sprl, artifact = line.strip().split(',', 2)
+            runs['/'.join([i, sprl])] = [int(comp) for comp in artifact.strip('"[]').split(',') if comp]
+
+    return(runs)
+
+# {run: {'flagged': [...], 'sha1': ...}} from the classification files of a study
+def classifications(directory):
+
+    runs = {}
+    for i, sprl in s2_identify_components.work_list(directory):
+        csv = os.path.join(directory, i, sprl, CSV_NAME)
+        runs['/'.join([i, sprl])] = {'flagged': s3_remove_flagged_components.read_flagged(csv),
+                                     'sha1': result_cache.file_hash(csv)}
+
+    return(runs)
+
+def benchmark(directory, repeat=3, backend='numpy'):
+
+    i, sprl = s2_identify_components.work_list(directory)[0]
+    melodicfile = os.path.join(directory, i, sprl, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
+    scratch = os.path.join(directory, 'benchmark_' + CSV_NAME)
+    # cleaned images go next to the study, where they are not mistaken for a subject folder
+    clean_img = directory + '_clean'
+    if not os.path.isdir(clean_img):
+        os.makedirs(clean_img)
+
+    with quiet():
+        times = {'check_slices': min(timed(check_slices.main, melodicfile, scratch, 3, 1) for n in range(max(1, repeat))),
+                 's2': timed(s2_identify_components.main, 3, 1, directory, force=True),
+                 's3': timed(s3_remove_flagged_components.main, directory, clean_img, directory, backend=backend)}
+    os.remove(scratch)
+
+    return(times)
+
+# compare the classifications of each study with the golden ones. Returns (differences, studies not in golden)
+def compare(results, golden):
+
+    differences, unchecked = [], []
+    for name in sorted(results):
+        if name not in golden:
+            unchecked.append(name)
+            continue
+        for run in sorted(set(results[name]) | set(golden[name])):
+            found, expected = results[name].get(run), golden[name].get(run)
+            if found != expected:
+                differences.append("{} {}: expected {}, got {}".format(name, run, expected, found))
+
+    return(differences, unchecked)
+
+def main(workdir, sizes, subjects=2, volumes=100, repeat=3, backend='numpy', golden=None, update_golden=False, json_file=None):
+
+    if golden is None:
+        golden = GOLDEN
+    # golden classifications are those of the reference fft, so that the other fft settings are checked against it
+    if update_golden and check_slices.fft_settings() != check_slices.FFTSettings('fftpack', 1, False):
+        raise ValueError("golden classifications must be recorded with the reference fft settings (FEENICS_FFT=fftpack, no workers or float32)")
+    if not update_golden and not os.path.exists(golden):
+        raise IOError("golden file {} not found, record it with --updateGolden".format(golden))
+
+    timings, results = {}, {}
+    print("{:>18} {:>14} {:>10} {:>10} {:>18}".format("size", "check_slices", "s2", "s3", "flagged/artifact"))
+    for size in sizes:
+        directory = study(workdir, size, subjects, volumes)
+        timings[size] = benchmark(directory, repeat, backend)
+        runs = results[study_name(size, subjects, volumes)] = classifications(directory)
+
+        expected = truth(directory)
+        found = sum(len(set(runs[run]['flagged']) & set(expected[run])) for run in expected)
+        flagged = sum(len(runs[run]['flagged']) for run in expected)
+        artifact = sum(len(expected[run]) for run in expected)
+        print("{:>18} {:>13.2f}s {:>9.2f}s {:>9.2f}s {:>8}/{}, {} correct".format(size, timings[size]['check_slices'], timings[size]['s2'], timings[size]['s3'], flagged, artifact, found))
+
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+
+    if update_golden:
+        with open(golden, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print("Wrote golden classifications to {}".format(golden))
+        return([])
+
+    with open(golden) as f:
+        differences, unchecked = compare(results, json.load(f))
+    if unchecked:
+        print("No golden classifications in {} for {}, not checked".format(golden, ', '.join(unchecked)))
+    if differences:
+        print("Classifications differ from {}:".format(golden))
+        for difference in differences:
+            print("  " + difference)
+    elif len(unchecked) < len(results):
+        print("Classifications match {}".format(golden))
+
+    return(differences)
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    differences = main(args.workdir, args.sizes.split(','), args.subjects, args.volumes, args.repeat, args.backend, args.golden, args.updateGolden, args.json)
+    if differences:
+        sys.exit(1)
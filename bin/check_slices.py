@@ -1,71 +1,280 @@
 #!/usr/bin/env python
 
+# Only numpy is imported up front. nibabel, scipy.fftpack, skimage.draw and the optional modules (ic_cache, qc_report and so matplotlib) are imported where they are first needed, so that importing this module, e.g. for classify in a long running service or in every worker process, stays cheap
 import numpy as np
-from numpy import ndarray
-import nibabel as nib
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import ylim
-from scipy.fftpack import fft2, fftshift
-from scipy import stats
-from scipy.stats import norm
-from skimage.draw import circle, ellipse
-from copy import copy
-import os, sys
-
-# organize values obtained from fft masks by slice number. Will then be used to calculate per slice thresholds. Slice values are skewed by probability of a normal distribution, in order to devalue outside slices.
-def slice_lists(z, masked_values, dist_factors):
-
-    totalperSliceMed = []
-    for x in range(z):
-        perSliceMed = [item[x] for item in masked_values]
-        perSliceFactor = dist_factors[x]*10
-        totalperSliceMed.append(perSliceMed/perSliceFactor)
-
-    return(totalperSliceMed)
-
-# define the first and third quartiles on a per slice number basis. Calculate the outliers based on the provided multiplier
-def cutoff(listB, multiplier):
-    # convert to numpy array
-    array = np.array(listB)
-
-    # find 1st and 3rd quartiles
-    quart_one = np.percentile(array, 25)
-    quart_three = np.percentile(array, 75)
+from collections import namedtuple
+import argparse
+import os, tempfile
+from instrument import stage
+import quantile_sketch
+
+# identifies the classification algorithm in cached results. Bump it whenever a change alters the classification output, so that s2_identify_components.py recomputes old results
+ALGORITHM_VERSION = '1'
+
+# organize values obtained from fft masks by slice number (ie. slice #zslice of every component together). Will then be used to calculate per slice thresholds. Slice values are skewed by probability of a normal distribution, in order to devalue outside slices.
+def slice_lists(masked_values, dist_factors, zslice):
+
+    perSliceMed = masked_values[:, zslice].astype(np.float64)
+    perSliceFactor = dist_factors[zslice]*10
+
+    return(perSliceMed/perSliceFactor)
+
+# define the first and third quartiles on a per slice number basis. Returns a (2, slices) array of the 1st and 3rd quartiles
+def quartiles(masked_values, dist_factors):
+
+    z = masked_values.shape[1]
+    quarts = np.empty((2, z))
+    for zslice in range(z):
+        quarts[:, zslice] = np.percentile(slice_lists(masked_values, dist_factors, zslice), [25, 75])
+
+    return(quarts)
+
+# sketch the values quartiles takes the quartiles of, for every slice (see quantile_sketch.py). Quartiles read from the sketch are within its relative accuracy of the exact ones, and sketches of several runs can be merged to pool their values
+def slice_sketch(masked_values, dist_factors):
+
+    z = masked_values.shape[1]
+    sketch = quantile_sketch.SliceSketch(z)
+    for zslice in range(z):
+        sketch.add(zslice, slice_lists(masked_values, dist_factors, zslice))
+
+    return(sketch)
+
+# Calculate the outliers of every slice based on the quartiles and the provided multiplier
+def cutoff(quarts, multiplier):
+
+    quart_one, quart_three = quarts
 
     # find difference between quartiles
     diff = quart_three-quart_one
     outliers = quart_three + diff*multiplier
     return(outliers)
 
-def main(input_comps, output_csv, factorA, factorB, plot=False):
+# count how many masked fft elements of each component pass the appropriate slice threshold. Returns a (comps, slices) matrix of counts
+def count_above(masked_values, cutoffs):
 
-    # input_comps = '/scratch/eziraldo/STOPPD_cleaning/2017_STOPPD_SpiralINOUT/20151110_Ex04578_STOP1MR_STKR063_SpiralSeparated/sprlIN/Prestats.feat/filtered_func_data.ica/melodic_IC.nii.gz'
-    # load sprl nifti
-    data = nib.load(input_comps).get_data()
-    x, y, z, comps =  data.shape
+    counts = np.empty(masked_values.shape[:2], dtype=int)
+    for zslice in range(len(cutoffs)):
+        counts[:, zslice] = (masked_values[:, zslice] > cutoffs[zslice]).sum(axis=1)
 
-    lo_comp, mid_comp = [], []
-    lo_comp_quart, mid_comp_quart, ratio_comp_quart = [], [], []
-    lo_byslice, mid_byslice, ratio_byslice = [], [], []
-    cutoff_mid_list, cutoff_lo_list, cutoff_ratio_list = [], [], []
+    return(counts)
 
-    remove_list = []
-    noise_comps = []
-    slices_list = []
-    dist_factors = []
+# count_above for several sets of slice thresholds at once. cutoffs has shape (n, slices) and the result (n, comps, slices). Each slice is sorted once, so the counts for every threshold come from a binary search rather than another pass over the values
+def count_above_sorted(masked_values, cutoffs):
+
+    comps, z, pixels = masked_values.shape
+    counts = np.empty((len(cutoffs), comps, z), dtype=int)
+    for zslice in range(z):
 
-    # defines the sizes of the masks
-    # mid mask is an ellipse stretching from the bottom left to top right corners of the matrix
-    mid_mask = np.zeros((x,y))
-    rr, cc = ellipse(x/2, y/2, x/4, y/2, rotation=np.deg2rad(40))
-    mid_mask[rr,cc] = 1
-    mid_mask = mid_mask.astype(np.bool)
+        # compare in the same precision that count_above's array > scalar comparison uses
+        dtype = np.result_type(masked_values[:1, zslice], cutoffs[0, zslice])
+        values = np.sort(masked_values[:, zslice], axis=1).astype(dtype)
+        thresholds = cutoffs[:, zslice].astype(dtype)
+
+        for comp in range(comps):
+            counts[:, comp, zslice] = pixels - np.searchsorted(values[comp], thresholds, side='right')
+
+    return(counts)
+
+# number of components transformed together when the whole volume is held in memory. Bounds the size of the batched fft, which holds x*y*z complex values per component
+COMPS_PER_CHUNK = 16
+
+# take the fast fourier transform of every slice of a block of components and shift so that from center to edge the frequency moves from low to high. Returns the power spectra with the same (x, y, z, comps) layout as the input block
+def power_spectra(block):
+    from scipy.fftpack import fft2, fftshift
+    return abs(fftshift(fft2(block, axes=(0, 1)), axes=(0, 1))**2)
+
+# fft implementations for the power spectra. fftpack computes the full complex spectrum (power_spectra) and is the reference; scipy (scipy.fft, scipy >= 1.4, optionally multithreaded) and numpy compute only the half spectrum of the real input (half_power_spectra)
+FFT_BACKENDS = ['fftpack', 'scipy', 'numpy']
+
+# backend, number of scipy.fft workers (-1 for every core) and whether to transform in single precision
+FFTSettings = namedtuple('FFTSettings', ['backend', 'workers', 'float32'])
+
+# the fft settings of this process, from the FEENICS_FFT, FEENICS_FFT_WORKERS and FEENICS_FFT_FLOAT32 environment variables (set by the --fft, --fftWorkers and --fftFloat32 options), so that worker processes use the same settings
+def fft_settings():
+
+    backend = os.environ.get('FEENICS_FFT') or 'fftpack'
+    if backend not in FFT_BACKENDS:
+        raise ValueError("FEENICS_FFT must be one of {}, got {}".format(', '.join(FFT_BACKENDS), backend))
+    workers = int(os.environ.get('FEENICS_FFT_WORKERS') or 1)
+    float32 = os.environ.get('FEENICS_FFT_FLOAT32', '') not in ('', '0')
+
+    return(FFTSettings(backend, workers, float32))
+
+# set the fft settings of this process and of the worker processes it starts from command line options. Options left as None (or False) keep the current setting
+def set_fft_options(backend=None, workers=None, float32=False):
+
+    if backend:
+        os.environ['FEENICS_FFT'] = backend
+    if workers:
+        os.environ['FEENICS_FFT_WORKERS'] = str(workers)
+    if float32:
+        os.environ['FEENICS_FFT_FLOAT32'] = '1'
+    fft_settings()
+
+# power spectra of every slice of a block of real components, keeping only the y//2+1 non-negative frequencies of the second axis and without shifting. Returns an (x, y//2+1, z, comps) array
+def half_power_spectra(block, settings):
+
+    if settings.backend == 'scipy':
+        import scipy.fft
+        spectra = scipy.fft.rfft2(block, axes=(0, 1), workers=settings.workers)
+    else:
+        spectra = np.fft.rfft2(block, axes=(0, 1))
+
+    pxx = spectra.real**2 + spectra.imag**2
+    if settings.float32:
+        pxx = pxx.astype(np.float32)
+    return(pxx)
+
+# flat indices into the (x, y//2+1) half spectrum of a real slice with the same power as the given flat indices into its shifted (x, y) full spectrum. The power of real input is symmetric, P[k1, k2] = P[-k1, -k2], so the negative frequencies of the second axis are read from their mirror image
+def half_spectrum_index(index, x, y):
+
+    i, j = np.unravel_index(index, (x, y))
+    # undo fftshift, which moves frequency 0 to the middle
+    k1 = (i - x//2) % x
+    k2 = (j - y//2) % y
+    mirror = k2 > y//2
+    k1 = np.where(mirror, (-k1) % x, k1)
+    k2 = np.where(mirror, (-k2) % y, k2)
+
+    return(k1*(y//2 + 1) + k2)
+
+# number of components that can be read and transformed together within mem_budget megabytes. Each component in flight holds its slab of the input, the complex fft, its shifted copy and the power spectrum
+def comps_per_chunk(shape, itemsize, mem_budget):
+    x, y, z = shape[:3]
+    per_comp = x*y*z*(itemsize + 3*16)
+    return max(1, int(mem_budget*2**20 // per_comp))
+
+class SpilledSpectra(object):
+    """
+    Masked spectra of shape (comps, slices, pixels) kept in a temporary file
+    rather than in memory. Values are stored slice by slice, so reading one
+    slice of every component (as cutoff and count_above do) is a single read.
+    """
+
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.file = tempfile.TemporaryFile()
+
+    def _offset(self, zslice, comp):
+        comps, z, pixels = self.shape
+        return (zslice*comps + comp)*pixels*self.dtype.itemsize
+
+    # store a block of consecutive components, values has shape (n, slices, pixels)
+    def __setitem__(self, index, values):
+        first = index.start or 0
+        for zslice in range(self.shape[1]):
+            self.file.seek(self._offset(zslice, first))
+            self.file.write(np.ascontiguousarray(values[:, zslice], dtype=self.dtype).tobytes())
+
+    # read back one slice of every component, ie. masked_values[:, zslice]
+    def __getitem__(self, index):
+        comps, z, pixels = self.shape
+        zslice = index[1]
+        self.file.seek(self._offset(zslice, 0))
+        values = np.frombuffer(self.file.read(comps*pixels*self.dtype.itemsize), dtype=self.dtype)
+        return values.reshape(comps, pixels)
+
+# frequency masks already built in this process, keyed by the (x, y) matrix size
+_mask_cache = {}
+
+# name of the cached masks of one matrix size. The masks depend on the mask definition and on how scikit-image draws ellipses and disks, so both versions are part of the name, and a cache directory shared between releases never serves masks built differently
+def mask_cache_name(x, y):
+
+    import skimage
+    return('feenics_masks_{}x{}_v{}_skimage{}.npz'.format(x, y, ALGORITHM_VERSION, skimage.__version__))
+
+# flat indices (into an x by y slice) of the mid and lo frequency areas of a shifted fft, in the same order as boolean mask indexing. Masks are built once per matrix size and kept in memory. If cache_dir (or the FEENICS_MASK_CACHE environment variable) is set, they are also stored there and reused by later runs of the same versions
+def frequency_masks(x, y, cache_dir=None):
+
+    if (x, y) in _mask_cache:
+        return(_mask_cache[(x, y)])
+
+    cache_dir = cache_dir or os.environ.get('FEENICS_MASK_CACHE')
+    cache_file = os.path.join(cache_dir, mask_cache_name(x, y)) if cache_dir else None
+
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            masks = (cached['mid_index'], cached['lo_index'])
+    else:
+        from skimage.draw import ellipse
+        try:
+            from skimage.draw import disk
+        except ImportError:
+            # scikit-image < 0.16 only has circle
+            from skimage.draw import circle
+            def disk(center, radius):
+                return circle(center[0], center[1], radius)
+
+        # defines the sizes of the masks
+        # mid mask is an ellipse stretching from the bottom left to top right corners of the matrix
+        mid_mask = np.zeros((x,y), dtype=bool)
+        rr, cc = ellipse(x/2, y/2, x/4, y/2, rotation=np.deg2rad(40))
+        mid_mask[rr,cc] = True
+
+        # low mask is very centre of image (1/5th radius)
+        lo_mask = np.zeros((x,y), dtype=bool)
+        rr, cc = disk((x/2, y/2), x/5)
+        lo_mask[rr, cc] = True
+
+        # mid mask excludes the low frequency centre
+        masks = (np.flatnonzero(mid_mask ^ lo_mask), np.flatnonzero(lo_mask))
+
+        if cache_file:
+            # write under a temporary name and rename, so concurrent runs never read a partial file
+            try:
+                handle, partial = tempfile.mkstemp(dir=cache_dir)
+                with os.fdopen(handle, 'wb') as f:
+                    np.savez(f, mid_index=masks[0], lo_index=masks[1])
+                os.rename(partial, cache_file)
+            except (IOError, OSError) as e:
+                print("Could not cache frequency masks in {}: {}".format(cache_dir, e))
+
+    _mask_cache[(x, y)] = masks
+    return(masks)
+
+# load the melodic components and calculate the masked lo and mid frequency power of every slice. Returns the masked values as (comps, slices, pixels) arrays, along with the slice weights used for the thresholds
+def masked_spectra(input_comps, mem_budget=None, timer=None):
+
+    # input_comps = '/scratch/eziraldo/STOPPD_cleaning/2017_STOPPD_SpiralINOUT/20151110_Ex04578_STOP1MR_STKR063_SpiralSeparated/sprlIN/Prestats.feat/filtered_func_data.ica/melodic_IC.nii.gz'
+    # load sprl nifti, unless input_comps is an (x, y, z, comps) array that is already loaded. If the FEENICS_IC_CACHE environment variable names a cache directory, the decompressed components are memory mapped from there (see ic_cache.py). With a memory budget (in MB) the components are streamed from disk in chunks through the nibabel proxy, and the masked spectra are spilled to a temporary file, so memory use does not grow with the number of components
+    with stage(timer, 'load'):
+        if isinstance(input_comps, np.ndarray):
+            if input_comps.ndim != 4:
+                raise ValueError("expected an (x, y, z, comps) array of components, got shape {}".format(input_comps.shape))
+            data = input_comps
+            shape, dtype = data.shape, data.dtype
+        elif os.environ.get('FEENICS_IC_CACHE'):
+            import ic_cache
+            data = ic_cache.load(input_comps, os.environ['FEENICS_IC_CACHE'])
+            shape, dtype = data.shape, data.dtype
+        else:
+            import nibabel as nib
+            img = nib.load(input_comps, keep_file_open=mem_budget is not None)
+            data = np.asanyarray(img.dataobj) if mem_budget is None else img.dataobj
+            shape, dtype = img.shape, img.get_data_dtype()
+        if mem_budget is None:
+            chunk = COMPS_PER_CHUNK
+        else:
+            chunk = comps_per_chunk(shape, dtype.itemsize, mem_budget)
+    x, y, z, comps = shape
+    if timer is not None:
+        timer.info.update(shape=[x, y, z], comps=comps, dtype=str(dtype), chunk=chunk)
+    voxels = x*y
+    mid_index, lo_index = frequency_masks(x, y)
+
+    # with a real input backend, only the half spectrum is computed and the mask indices are mapped onto it
+    settings = fft_settings()
+    half = settings.backend != 'fftpack'
+    if half:
+        mid_index, lo_index = half_spectrum_index(mid_index, x, y), half_spectrum_index(lo_index, x, y)
+        voxels = x*(y//2 + 1)
+    if timer is not None:
+        timer.info.update(fft=settings._asdict())
+
+    lo_comp, mid_comp = None, None
 
-    # low mask is very centre of image (1/5th radius)
-    lo_mask = np.zeros((x,y))
-    rr, cc = circle(x/2, y/2, x/5)
-    lo_mask[rr, cc] = 1
-    lo_mask = lo_mask.astype(np.bool)
+    slices_list = []
 
     # append slice numbers into list, calculate the mean, std and probability distribution. Will be used to skew weight of slices based on relative position in the brain. i.e. outside slices are not as valuable when deciding to keep or remove a component
     for zslice in range(z):
@@ -74,128 +283,111 @@ def main(input_comps, output_csv, factorA, factorB, plot=False):
     mean = np.mean(slices_list)
     std = np.std(slices_list)
 
-    for x in slices_list:
-        dist = norm.pdf(x, mean, std)
-        dist_factors.append(dist)
+    # normal probability density of each slice number, computed as scipy.stats.norm.pdf(x, mean, std) does (and to the same bits), without importing scipy.stats
+    standard = (np.array(slices_list) - mean) / std
+    dist_factors = list(np.exp(-standard**2/2.0) / np.sqrt(2*np.pi) / std)
 
-    # calculate thresholds for each component
-    for comp in range(comps):
+    # calculate the power spectra in chunks of components, keeping the masked lo and mid frequency values of each slice for the threshold and counting passes
+    for first in range(0, comps, chunk):
+        last = min(first + chunk, comps)
+        with stage(timer, 'load'):
+            block = np.asanyarray(data[:, :, :, first:last])
+        with stage(timer, 'fft'):
+            if settings.float32:
+                block = block.astype(np.float32)
+            pxx = half_power_spectra(block, settings) if half else power_spectra(block)
 
-        lo_slices, mid_slices, ratio_slices = [], [], []
-        lo_slices_quart, mid_slices_quart, ratio_slices_quart = [], [], []
+        with stage(timer, 'mask'):
+            # masked values are stored as (comps, slices, pixels) arrays, in the precision of the fft
+            if mid_comp is None:
+                allocate = np.empty if mem_budget is None else SpilledSpectra
+                mid_comp = allocate((comps, z, len(mid_index)), pxx.dtype)
+                lo_comp = allocate((comps, z, len(lo_index)), pxx.dtype)
 
-        for zslice in range(z):
+            # use masks to isolate lo and mid frequency areas of fft representation, gathering the masked pixels of every slice directly
+            pxx = pxx.reshape(voxels, z, last-first)
+            mid_comp[first:last] = pxx[mid_index].transpose(2, 1, 0)
+            lo_comp[first:last] = pxx[lo_index].transpose(2, 1, 0)
 
-            # take the fast fourier transform of each slice and shift so that from center to edge the frequency moves from low to high. Images contian mostly low frequency information
-            pxx = abs(fftshift(fft2(data[:,:,zslice, comp]))**2)
+    return(mid_comp, lo_comp, dist_factors)
 
-            # if plot option is specified, a colour map of each slice fft will be displayed
-            if plot==True:
-                pxxPlot = abs(fftshift(fft2(data[:,:,zslice, comp]))**2)
-                plt.imshow(pxxPlot, vmin = 0, vmax = 50000)
-                plt.colorbar()
-                plt.title('comp={} slice {}'.format(comp+1, zslice+1))
-                plt.show()
+# results of classifying one melodic_IC file. cutoff_mid and cutoff_lo are the per slice thresholds, mid_counts and lo_counts the (comps, slices) number of masked fft elements above them, points the total points of each component and flags whether each component is to be removed
+Classification = namedtuple('Classification', ['cutoff_mid', 'cutoff_lo', 'mid_counts', 'lo_counts', 'points', 'flags'])
 
-            # use masks to isolate lo and mid frequency areas of fft representation
-            mid_pxx = pxx[mid_mask - lo_mask]
-            lo_pxx = pxx[lo_mask]
+# Evaluation criteria for deciding to assign points to slices for noise or signal, as (comps, slices) boolean matrices. Artifact slices have an overwhelming contribution from mid frequency loading (negative ratio), signal slices have mostly low frequency loading
+def slice_rules(mid_counts, lo_counts):
 
-            # append sorted slices into a list
-            mid_slices.append(ndarray.tolist(mid_pxx))
-            lo_slices.append(ndarray.tolist(lo_pxx))
+    ratio = lo_counts - mid_counts
+    artifact = ratio < -100
+    signal = (lo_counts > 20) & (ratio >= 10)
 
-        # appended components into list of lists
-        mid_comp.append(mid_slices)
-        lo_comp.append(lo_slices)
+    return(artifact, signal)
 
-    #  create lists sorted per slice number (ie. slice #1 for every component together)
-    mid_byslice = slice_lists(z, mid_comp, dist_factors)
-    lo_byslice = slice_lists(z, lo_comp, dist_factors)
+# Positive points indicate noise, negative points indicate signal. Only the first artifact slice of a component scores (2 points), acknowledging the possibility of more than one slice with artifact without applying further points. Every signal slice scores -1. If the total component points are greater than 0, then remove the component
+def score_components(mid_counts, lo_counts):
 
-    # calculate the cutoff for each slice (both mid frequency and low frequency)
-    for slices in mid_byslice:
+    artifact, signal = slice_rules(mid_counts, lo_counts)
+    points = 2*artifact.any(axis=1) - signal.sum(axis=1)
+    flags = points > 0
 
-        cutoff_mid = cutoff(slices, factorA)
-        cutoff_mid_list.append(cutoff_mid)
-        #     print(cutoff_mid)
-        # print('\n')
+    return(points, flags)
 
-    for slices in lo_byslice:
-        cutoff_lo = cutoff(slices, factorB)
-        cutoff_lo_list.append(cutoff_lo)
+# calculate the thresholds, counts and points of every component from the masked spectra. The thresholds come from the exact quartiles of the run, unless quarts gives the (mid, lo) quartiles to use instead
+def classify_spectra(mid_comp, lo_comp, dist_factors, factorA, factorB, timer=None, quarts=None):
 
-    # print(cutoff_mid_list)
-    # print(cutoff_lo_list)
+    # calculate the cutoff for each slice (both mid frequency and low frequency)
+    with stage(timer, 'thresholds'):
+        if quarts is None:
+            quarts = (quartiles(mid_comp, dist_factors), quartiles(lo_comp, dist_factors))
+        cutoff_mid = cutoff(quarts[0], factorA)
+        cutoff_lo = cutoff(quarts[1], factorB)
 
     # count how many masked fft elements pass the appropriate slice threshold
-    for comp in range(comps):
-        lo_slices_quart, mid_slices_quart, ratio_slices_quart = [], [], []
-        for zslice in range(z):
+    with stage(timer, 'count'):
+        mid_counts = count_above(mid_comp, cutoff_mid)
+        lo_counts = count_above(lo_comp, cutoff_lo)
 
-            # use masks to isolate lo and mid frequency areas of fft representation
-            pxx = abs(fftshift(fft2(data[:,:,zslice, comp]))**2)
-            mid_pxx = pxx[mid_mask - lo_mask]
-            lo_pxx = pxx[lo_mask]
+    with stage(timer, 'score'):
+        points, flags = score_components(mid_counts, lo_counts)
+    return(Classification(cutoff_mid, cutoff_lo, mid_counts, lo_counts, points, flags))
 
-            count_mid = np.asarray(np.where(mid_pxx > cutoff_mid_list[zslice]))
-            count_lo = np.asarray(np.where(lo_pxx > cutoff_lo_list[zslice]))
+# component numbers (starting at 1) flagged for removal
+def noise_components(flags):
+    return([int(comp)+1 for comp in np.flatnonzero(flags)])
 
-            mid_count = count_mid.shape
-            lo_count = count_lo.shape
+# write the results to a compressed numpy archive, with one array per Classification field
+def save_results(output_npz, results):
+    np.savez_compressed(output_npz, **results._asdict())
 
-            lo_slices_quart.append(lo_count[1])
-            mid_slices_quart.append(mid_count[1])
-            ratio_slices_quart.append(lo_count[1]-mid_count[1])
+# read results written by save_results
+def load_results(input_npz):
+    with np.load(input_npz) as archive:
+        return(Classification(*[archive[field] for field in Classification._fields]))
 
-        lo_comp_quart.append(lo_slices_quart)
-        mid_comp_quart.append(mid_slices_quart)
-        ratio_comp_quart.append(ratio_slices_quart)
+# write the classification file: per slice thresholds, per slice results and total points per component, and finally the list of components to be removed
+def write_classification(output_csv, results):
 
-    # Evaluation criteria for deciding to assign points to slices for noise or signal. Positive points indicate noise, negative points indicate signal.
-    for comp in range(comps):
-        flag = False
-        remove = False
-        points = 0
-        a = 0
+    cutoff_mid_list, cutoff_lo_list = results.cutoff_mid, results.cutoff_lo
+    mid_comp_quart, lo_comp_quart = results.mid_counts, results.lo_counts
+    ratio_comp_quart = lo_comp_quart - mid_comp_quart
+    comps, z = mid_comp_quart.shape
 
-        for zslice in range(z):
+    artifact, signal = slice_rules(mid_comp_quart, lo_comp_quart)
+    first_artifact = artifact & (np.cumsum(artifact, axis=1) == 1)
 
-            # print("{} {} {} {} {}".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-
-            # this is the artifact case. Negative ratio comp indicates overwhelming contribution from mid fequency loading
-            if ratio_comp_quart[comp][zslice] < -100 and a == 0:
-
-                a = 1
-                points = points + 2
-                remove_list.append("{},{},{},{},{},2".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-                # print("{},{},{},{},{},noise".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-
-            # this case exists to acknowledge the possibility of more than one slice with artifact, but not apply further points if the previous statement has already been executed
-            elif ratio_comp_quart[comp][zslice] < -100:
-
-                remove_list.append("{},{},{},{},{},0".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-                # print("{},{},{},{},{},noise".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-
-            if lo_comp_quart[comp][zslice] > 20 and ratio_comp_quart[comp][zslice] >= 10 :
-
-                value = -1
-                remove_list.append("{},{},{},{},{},-1".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-                # print("{},{},{},{},{},signal".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
-                points = points - 1
-
-            # print("{},{},{},{},{}".format(comp+1, zslice+1, mid_comp_quart[comp][zslice], lo_comp_quart[comp][zslice], ratio_comp_quart[comp][zslice]))
+    remove_list = []
+    for comp in range(comps):
+        for zslice in np.flatnonzero(artifact[comp] | signal[comp]):
 
-        # If the total component points are greater than 0, then remove the component
-        if points > 0:
-            flag = True
-        else:
-            flag = False
+            counts = "{},{},{},{},{}".format(comp+1, zslice+1, mid_comp_quart[comp, zslice], lo_comp_quart[comp, zslice], ratio_comp_quart[comp, zslice])
+            if artifact[comp, zslice]:
+                remove_list.append(counts + (",2" if first_artifact[comp, zslice] else ",0"))
+            if signal[comp, zslice]:
+                remove_list.append(counts + ",-1")
 
-        if flag == True:
-            noise_comps.append(str(comp+1))
+        remove_list.append("Comp: {}, Total Points: {}, Flag: {}".format(comp+1, int(results.points[comp]), bool(results.flags[comp])))
 
-        remove_list.append("Comp: {}, Total Points: {}, Flag: {}".format(comp+1, points, flag))
+    noise_comps = [str(comp) for comp in noise_components(results.flags)]
 
     thresholds_list = []
 
@@ -219,14 +411,110 @@ def main(input_comps, output_csv, factorA, factorB, plot=False):
     f.write('\n')
     f.write('[' + ','.join(noise_comps) + ']' + '\n')
 
+# folder the QC images of output_csv are rendered to when plot is set and no qc_dir is given
+def default_qc_dir(output_csv):
+    return(os.path.join(os.path.dirname(os.path.abspath(output_csv)), 'qc'))
+
+# (mid, lo) quartiles of every slice read from merged quantile sketches, given as the (mid, lo) SliceSketch pair or the file quantile_sketch.py wrote them to. The sketches must be of runs with the given number of slices
+def pooled_quartiles(pooled, slices):
+
+    sketches = pooled if isinstance(pooled, tuple) else quantile_sketch.load(pooled)
+    if sketches[0].counts.shape[0] != slices:
+        raise ValueError("the pooled sketches have {} slices, the run has {}".format(sketches[0].counts.shape[0], slices))
+
+    return(tuple(sketch.percentiles([25, 75]) for sketch in sketches))
+
+# classify the components of array_or_path, an (x, y, z, comps) array already in memory or the path of a melodic_IC file, without writing any file. Returns the Classification: per slice thresholds, (comps, slices) counts, and the points and flags of each component (check_slices.noise_components gives the flagged component numbers). Takes the same mem_budget, pooled and timer as main
+def classify(array_or_path, mid_factor, low_factor, mem_budget=None, pooled=None, timer=None):
+
+    mid_comp, lo_comp, dist_factors = masked_spectra(array_or_path, mem_budget, timer)
+    quarts = pooled_quartiles(pooled, len(dist_factors)) if pooled is not None else None
+
+    return(classify_spectra(mid_comp, lo_comp, dist_factors, float(mid_factor), float(low_factor), timer, quarts))
+
+# classify the components of input_comps (a melodic_IC path, or its data already loaded as an (x, y, z, comps) array) and write the classification file to output_csv, and optionally the results archive to output_npz. Returns the Classification. If an instrument.StageTimer is given, the time and memory of each stage are recorded in it. If qc_dir is given (or plot is set), a montage of the masked spectra of each component and an index.html are rendered there by qc_jobs worker processes (see qc_report.py). The mid and lo sketches of the run are written to output_sketch if given. The thresholds are taken from the run's sketches if sketch_thresholds is set, or from the merged sketches in the file pooled (e.g. of a whole study), instead of the exact quartiles of the run
+def main(input_comps, output_csv, factorA, factorB, plot=False, mem_budget=None, output_npz=None, timer=None, qc_dir=None, qc_jobs=1, output_sketch=None, sketch_thresholds=False, pooled=None):
+
+    mid_comp, lo_comp, dist_factors = masked_spectra(input_comps, mem_budget, timer)
+
+    sketches = None
+    if output_sketch is not None or (sketch_thresholds and pooled is None):
+        with stage(timer, 'sketch'):
+            sketches = (slice_sketch(mid_comp, dist_factors), slice_sketch(lo_comp, dist_factors))
+            if output_sketch is not None:
+                quantile_sketch.save(output_sketch, *sketches)
+
+    quarts = None
+    if pooled is not None:
+        quarts = pooled_quartiles(pooled, len(dist_factors))
+    elif sketch_thresholds:
+        quarts = tuple(sketch.percentiles([25, 75]) for sketch in sketches)
+    results = classify_spectra(mid_comp, lo_comp, dist_factors, factorA, factorB, timer, quarts)
+
+    with stage(timer, 'write'):
+        write_classification(output_csv, results)
+        if output_npz is not None:
+            save_results(output_npz, results)
+
+    if plot and qc_dir is None:
+        qc_dir = default_qc_dir(output_csv)
+    if qc_dir is not None:
+        with stage(timer, 'qc'):
+            # imported here so that classifying without QC never needs matplotlib
+            import nibabel as nib
+            import qc_report
+            shape = input_comps.shape if isinstance(input_comps, np.ndarray) else nib.load(input_comps).shape
+            qc_report.render(qc_dir, mid_comp, lo_comp, results, shape, os.path.basename(os.path.normpath(qc_dir)), qc_jobs)
+
+    return(results)
+
+# classify the components for every (factorA, factorB) pair in factor_pairs, calculating the spectra and quartiles only once. Returns a list of (factorA, factorB, noise_comps), where noise_comps are the component numbers main would flag for that pair
+def sweep(input_comps, factor_pairs, mem_budget=None):
+
+    mid_comp, lo_comp, dist_factors = masked_spectra(input_comps, mem_budget)
+    mid_quarts = quartiles(mid_comp, dist_factors)
+    lo_quarts = quartiles(lo_comp, dist_factors)
+
+    # mid counts only depend on factorA and lo counts only on factorB, so count once per distinct factor
+    mid_factors = sorted(set(factorA for factorA, factorB in factor_pairs))
+    lo_factors = sorted(set(factorB for factorA, factorB in factor_pairs))
+    mid_counts = count_above_sorted(mid_comp, np.array([cutoff(mid_quarts, factor) for factor in mid_factors]))
+    lo_counts = count_above_sorted(lo_comp, np.array([cutoff(lo_quarts, factor) for factor in lo_factors]))
+
+    results = []
+    for factorA, factorB in factor_pairs:
+        points, flags = score_components(mid_counts[mid_factors.index(factorA)], lo_counts[lo_factors.index(factorB)])
+        results.append((factorA, factorB, noise_components(flags)))
+
+    return(results)
 
 if __name__ == '__main__':
 
-    input_comps = sys.argv[1]
-    output = sys.argv[2]
-    factorA = float(sys.argv[3])
-    factorB = float(sys.argv[4])
-    if len(sys.argv) == 6:
-        if sys.argv[5] == 'plot':
-            main(input_comps, output, plot=True)
-    main(input_comps, output, factorA, factorB)
+    parser = argparse.ArgumentParser(description="Classify the components of a single melodic_IC file as spiral noise or signal")
+    parser.add_argument("melodic_file", help="path to any melodic_IC.nii.gz file")
+    parser.add_argument("outputname", help="path to desired output classification file location")
+    parser.add_argument("factorA", type=float, help="multiplier used to determine mid/high frequency cutoffs")
+    parser.add_argument("factorB", type=float, help="multiplier used to determine low frequency cutoffs")
+    parser.add_argument("plot", nargs='?', choices=['plot'], help="render QC images of the fft of every slice to a qc folder next to outputname (same as --qc)")
+    parser.add_argument("--sketch", help="also write the mid and lo quantile sketches of every slice to this .npz file, to be merged with those of other runs by quantile_sketch.py")
+    parser.add_argument("--sketchThresholds", action='store_true', help="take the thresholds from the quantile sketches of the run instead of its exact quartiles")
+    parser.add_argument("--pooled", help="take the thresholds from the merged quantile sketches in this file (e.g. of a whole study) instead of the quartiles of the run")
+    parser.add_argument("--qc", help="folder in which to render a QC montage of the masked fft of every slice of each component, with an index.html")
+    parser.add_argument("--qcJobs", type=int, default=1, help="number of processes rendering the QC images. Default is 1.")
+    parser.add_argument("--memBudget", type=float, help="stream components from disk using roughly this many MB, instead of loading the whole file")
+    parser.add_argument("--npz", help="also write the thresholds, per slice counts, points and flags to this .npz file")
+    parser.add_argument("--icCache", help="directory in which to keep a decompressed, memory mapped copy of melodic_file for later runs. Same as setting FEENICS_IC_CACHE.")
+    parser.add_argument("--icCacheLimit", type=float, help="size limit of the --icCache directory in MB, least recently used files are removed first. Same as setting FEENICS_IC_CACHE_MB. Default is 4096.")
+    parser.add_argument("--fft", choices=FFT_BACKENDS, help="fft implementation. fftpack (default) computes the full complex spectrum as always; scipy (scipy >= 1.4) and numpy compute only the half spectrum of the real components, which is faster and matches fftpack to float32 rounding. Same as setting FEENICS_FFT.")
+    parser.add_argument("--fftWorkers", type=int, help="number of threads for --fft scipy, -1 for every core. Same as setting FEENICS_FFT_WORKERS. Default is 1.")
+    parser.add_argument("--fftFloat32", action='store_true', help="transform in single precision, even if melodic_file is stored as float64. Same as setting FEENICS_FFT_FLOAT32=1.")
+    args = parser.parse_args()
+
+    set_fft_options(args.fft, args.fftWorkers, args.fftFloat32)
+    if args.icCache:
+        os.environ['FEENICS_IC_CACHE'] = args.icCache
+    if args.icCacheLimit:
+        os.environ['FEENICS_IC_CACHE_MB'] = str(args.icCacheLimit)
+
+    main(args.melodic_file, args.outputname, args.factorA, args.factorB, plot=args.plot == 'plot', mem_budget=args.memBudget, output_npz=args.npz, qc_dir=args.qc, qc_jobs=args.qcJobs,
+         output_sketch=args.sketch, sketch_thresholds=args.sketchThresholds, pooled=args.pooled)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Runs the FSL preprocessing steps of s1_folder_setup.py on the local machine.
+
+Each run folder (subject/sprl) is a chain of steps, mcflirt -> bet -> fslmaths
+-> melodic, where every step reads the output of the one before. Chains of
+different runs are independent, and up to `jobs` chains run at once, each
+step waiting for its command to finish and checking its exit status.
+
+A step is skipped when its output already exists, so an interrupted study can
+simply be set up again. While a step runs, a .feenics_<step>.running marker is
+kept in the run folder; if it is still there on the next call, the step was
+interrupted, so the step and every step after it are run again. The output
+of a step is removed before it runs, so a rerun never sits next to stale
+results. The output of each command goes to
+feenics_<step>.log in the run folder.
+"""
+
+from multiprocessing.pool import ThreadPool
+import os, shutil, subprocess, threading
+
+# chains run in threads, so keep their messages from interleaving
+_print_lock = threading.Lock()
+
+def report(message):
+    with _print_lock:
+        print(message)
+
+# (name, message, command, output) for each preprocessing step of one run folder, in dependency order. Commands run inside the run folder
+def fsl_steps(subfolder):
+
+    return([
+        ('mcflirt', "Motion correcting", ["mcflirt", "-in", subfolder, "-refvol", "2", "-out", "motion_corr", "-plots"], "motion_corr.nii.gz"),
+        ('bet', "Brain extracting", ["bet", "motion_corr", "mask", "-f", "0.4", "-m", "-n"], "mask_mask.nii.gz"),
+        ('fslmaths', "Masking", ["fslmaths", "motion_corr", "-mas", "mask_mask", "filtered_func_data"], "filtered_func_data.nii.gz"),
+        ('melodic', "Running ICA (melodic)", ["melodic", "-i", "filtered_func_data", "-o", "filtered_func_data.ica", "-v", "--nobet", "--bgthreshold=0", "-d", "0", "--report", "--guireport=../../report.html"], os.path.join("filtered_func_data.ica", "melodic_IC.nii.gz")),
+    ])
+
+# remove the output an earlier or interrupted run of a step left behind. melodic writes a whole folder, and would otherwise write to filtered_func_data.ica+ next time
+def remove_partial(rundir, output):
+
+    top = os.path.join(rundir, output.split(os.sep)[0])
+    if os.path.isdir(top):
+        shutil.rmtree(top)
+    elif os.path.exists(top):
+        os.remove(top)
+
+# run the steps of one run folder in order, stopping at the first failure. Returns (label, None) on success, or (label, reason) naming the step that failed
+def run_chain(rundir, steps, label):
+
+    rerun = False
+    for name, message, cmd, output in steps:
+        marker = os.path.join(rundir, '.feenics_{}.running'.format(name))
+        interrupted = os.path.exists(marker)
+
+        if not (rerun or interrupted) and os.path.exists(os.path.join(rundir, output)):
+            continue
+
+        if interrupted:
+            report("Rerunning interrupted {} for {}".format(name, label))
+
+        # clear the output of an interrupted step, or of a step rerun because an earlier one was, so melodic never writes beside a stale filtered_func_data.ica
+        remove_partial(rundir, output)
+
+        report("{} {}".format(message, label))
+        open(marker, 'w').close()
+        logfile = os.path.join(rundir, 'feenics_{}.log'.format(name))
+        try:
+            with open(logfile, 'w') as log:
+                returncode = subprocess.call(cmd, cwd=rundir, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            return(label, "{} could not be run, is FSL on the path? ({})".format(cmd[0], e))
+
+        if returncode != 0:
+            return(label, "{} failed with exit status {}, see {}".format(name, returncode, logfile))
+        if not os.path.exists(os.path.join(rundir, output)):
+            return(label, "{} did not create {}, see {}".format(name, output, logfile))
+
+        os.remove(marker)
+        rerun = True
+
+    return(label, None)
+
+# run the preprocessing of every (rundir, subfolder, label) in runs, with up to jobs run folders at once. Returns the (label, reason) of each failed run
+def run_all(runs, jobs=1):
+
+    def chain(run):
+        rundir, subfolder, label = run
+        return(run_chain(rundir, fsl_steps(subfolder), label))
+
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(chain, runs)
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = [(label, reason) for label, reason in results if reason is not None]
+    print("FSL preprocessing: {} runs complete, {} runs failed".format(len(results) - len(failures), len(failures)))
+    for label, reason in failures:
+        print("  failed: {}: {}".format(label, reason))
+
+    return(failures)
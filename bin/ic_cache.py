@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Opt-in cache of decompressed melodic_IC files for check_slices.py.
+
+Every pass over a run (tuning factors, plotting, rescoring) otherwise gunzips
+melodic_IC.nii.gz again. With a cache directory, the first pass writes the
+decompressed components to an uncompressed .npy file there, and later passes
+open that file with mmap, so reading a run costs about as much as a page
+cache read and nothing is copied until components are used.
+
+Entries are named after the absolute path of the melodic_IC file and its size
+and mtime, so an edited or replaced file is never served from the cache, and
+its old entry is removed. The directory is kept under a size limit by
+removing the least recently used entries (each hit updates the entry's mtime).
+The entry just written is never removed, even if it alone exceeds the limit.
+"""
+
+import glob
+import hashlib
+import os, tempfile
+import numpy as np
+import nibabel as nib
+from numpy.lib.format import open_memmap
+
+# cache size limit in MB when none is given and FEENICS_IC_CACHE_MB is not set
+DEFAULT_LIMIT_MB = 4096
+
+# MB of components decompressed at a time when filling a new entry, so a cache miss never needs the whole file in memory
+FILL_MB = 64
+
+def entry_prefix(path):
+    return(hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:20])
+
+# cache file name for path in its current state
+def entry_name(path, stat):
+    return('{}-{}-{}.npy'.format(entry_prefix(path), stat.st_size, int(round(stat.st_mtime * 1e6))))
+
+# decompress the nifti at path into a new .npy file at entry, a chunk of components at a time. Written under a temporary name and renamed, so a crash never leaves a truncated entry
+def fill(path, entry):
+
+    img = nib.load(path, keep_file_open=True)
+    shape = img.shape
+    per_comp = int(np.prod(shape[:-1])) * img.get_data_dtype().itemsize
+    step = max(1, int(FILL_MB * 2**20 // per_comp))
+
+    handle, partial = tempfile.mkstemp(dir=os.path.dirname(entry), suffix='.npy.partial')
+    os.close(handle)
+    os.chmod(partial, 0o644)
+    try:
+        out = None
+        for first in range(0, shape[-1], step):
+            block = np.asanyarray(img.dataobj[..., first:first + step])
+            if out is None:
+                # nifti data is stored with x varying fastest, as np.asanyarray(img.dataobj) returns it
+                out = open_memmap(partial, mode='w+', dtype=block.dtype, shape=shape, fortran_order=True)
+            out[..., first:first + step] = block
+        out.flush()
+        del out
+        os.rename(partial, entry)
+    except:
+        os.remove(partial)
+        raise
+
+# remove the least recently used entries of cache_dir until it holds at most limit_mb, keeping the entry keep
+def evict(cache_dir, limit_mb, keep=None):
+
+    entries = []
+    for entry in glob.glob(os.path.join(cache_dir, '*-*-*.npy')):
+        try:
+            stat = os.stat(entry)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total = sum(size for used, size, entry in entries)
+    for used, size, entry in sorted(entries):
+        if total <= limit_mb * 2**20:
+            break
+        if entry == keep:
+            continue
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+        total -= size
+
+# the components of the melodic_IC file at path as a read only memory mapped array, with the same dtype, values and layout as np.asanyarray(nib.load(path).dataobj). The cached copy in cache_dir is used if it is up to date, otherwise it is (re)written first
+def load(path, cache_dir, limit_mb=None):
+
+    stat = os.stat(path)
+    entry = os.path.join(cache_dir, entry_name(path, stat))
+
+    if os.path.exists(entry):
+        try:
+            data = np.load(entry, mmap_mode='r')
+            os.utime(entry, None)
+            return(data)
+        except (IOError, OSError, ValueError):
+            pass
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for stale in glob.glob(os.path.join(cache_dir, entry_prefix(path) + '-*.npy')):
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+    fill(path, entry)
+    if limit_mb is None:
+        limit_mb = float(os.environ.get('FEENICS_IC_CACHE_MB', DEFAULT_LIMIT_MB))
+    evict(cache_dir, limit_mb, keep=entry)
+
+    return(np.load(entry, mmap_mode='r'))
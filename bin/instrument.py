@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Optional per stage instrumentation for the FeenICS pipeline.
+
+A StageTimer collects, for one run, the wall time of each named stage and the
+peak memory within it: the peak resident set size of the process during the
+stage and, when tracemalloc is tracing (e.g. PYTHONTRACEMALLOC=1 is set, with
+python 3.9+), the peak of the allocations made within the stage, numpy arrays
+included. Tracing is never started here, as it slows every allocation of the
+process and so the times being measured. On linux the resident set high-water mark is reset at
+the start of every stage (through /proc/self/clear_refs), so each stage and
+each run reports its own peak; elsewhere it is the lifetime peak of the
+process. Memory freed by earlier stages or runs may stay resident, so only
+the traced allocations attribute memory to a single stage.
+Stages entered more than once (e.g. reading and transforming each chunk of
+components) are accumulated: their times are added, and their largest peak
+is kept.
+Records are written one JSON object per line, so files from several runs or
+nodes can simply be concatenated.
+"""
+
+import contextlib
+import json
+import resource
+import sys, time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# peak resident set size of this process in MB. ru_maxrss is in kB on linux but bytes on macOS
+def peak_rss_mb():
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024.
+    return(peak / 1024.)
+
+# reset the resident set high-water mark of this process (linux 4.0+). Returns whether it could be reset
+def reset_peak_rss():
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return(False)
+    return(True)
+
+# resident set high-water mark in MB since the last reset_peak_rss, or the lifetime peak where there is none
+def stage_peak_rss_mb():
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) / 1024.)
+    except (IOError, OSError):
+        pass
+    return(peak_rss_mb())
+
+class StageTimer(object):
+
+    def __init__(self, **info):
+        self.info = dict(info)
+        self.stages = []
+        self.seconds = {}
+        self.rss_mb = {}
+        self.alloc_mb = {}
+
+        self.resettable = reset_peak_rss()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        tracing = tracemalloc is not None and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        if tracing:
+            tracemalloc.reset_peak()
+        if self.resettable:
+            reset_peak_rss()
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            if name not in self.seconds:
+                self.stages.append(name)
+                self.seconds[name] = 0.
+            self.seconds[name] += time.time() - start
+            self.rss_mb[name] = round(max(stage_peak_rss_mb(), self.rss_mb.get(name, 0)), 1)
+            if tracing:
+                alloc = tracemalloc.get_traced_memory()[1] / 2.**20
+                self.alloc_mb[name] = round(max(alloc, self.alloc_mb.get(name, 0)), 1)
+
+    def record(self):
+
+        record = dict(self.info)
+        record['stages'] = [dict([('stage', name), ('seconds', round(self.seconds[name], 4)), ('peak_rss_mb', self.rss_mb[name])] +
+                                 ([('peak_alloc_mb', self.alloc_mb[name])] if name in self.alloc_mb else []))
+                            for name in self.stages]
+        record['seconds'] = round(sum(self.seconds.values()), 4)
+        record['peak_rss_mb'] = max(self.rss_mb.values()) if self.resettable and self.rss_mb else round(peak_rss_mb(), 1)
+        return(record)
+
+# time the body as a stage of timer, or do nothing when timer is None
+@contextlib.contextmanager
+def stage(timer, name):
+
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+def write_records(path, records):
+
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
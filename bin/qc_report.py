@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Headless quality control images of a check_slices classification.
+
+For every component, one montage of the power spectra of all its slices is
+rendered with matplotlib's Agg backend (no display needed): the mid and lo
+frequency areas the classification looked at, with the outline of each mask,
+and above each slice its number, mid and lo counts. Slice titles are red for
+slices scored as artifact and green for slices scored as signal. The images
+are built from the masked spectra check_slices has already computed, so no
+fft is repeated, and are rendered in a pool of worker processes.
+
+Each run folder gets summary.json and index.html, and write_index makes an
+index.html for a folder of runs (e.g. the sprlIN and sprlOUT of a subject).
+"""
+
+import json
+import math
+import multiprocessing
+import os, tempfile
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import check_slices
+
+SUMMARY_NAME = 'summary.json'
+INDEX_NAME = 'index.html'
+
+# pixels of a boolean mask with a 4-neighbour outside it
+def outline(mask):
+
+    padded = np.pad(mask, 1, mode='constant')
+    inside = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return(mask & ~inside)
+
+# (x, y) boolean image of the outlines of the mid and lo frequency masks of check_slices
+def mask_outlines(x, y):
+
+    mid_index, lo_index = check_slices.frequency_masks(x, y)
+    mid, lo = np.zeros(x*y, dtype=bool), np.zeros(x*y, dtype=bool)
+    mid[mid_index] = True
+    lo[lo_index] = True
+
+    # the mid mask excludes the lo area, so its outline is that of both together
+    return(outline((mid | lo).reshape(x, y)) | outline(lo.reshape(x, y)))
+
+# log10(1 + power) of the masked spectra of components first to last, as (comps, slices, x, y) images, NaN outside the masks
+def spectra_images(mid_comp, lo_comp, x, y, first, last):
+
+    mid_index, lo_index = check_slices.frequency_masks(x, y)
+    z = mid_comp.shape[1]
+
+    images = np.full((last - first, z, x*y), np.nan, dtype=np.float32)
+    for zslice in range(z):
+        images[:, zslice, mid_index] = mid_comp[:, zslice][first:last]
+        images[:, zslice, lo_index] = lo_comp[:, zslice][first:last]
+
+    return(np.log10(1 + images).reshape(last - first, z, x, y))
+
+# render the montage of one component. job is (images, comp, points, flagged, mid_counts, lo_counts, artifact, signal, edges, path), the per slice arrays covering every slice of the component. The slices are coloured and tiled into a single RGB image, with a gap above each for its label, and drawn as one image, which is much faster than an axes per slice
+def render_component(job):
+
+    images, comp, points, flagged, mid_counts, lo_counts, artifact, signal, edges, path = job
+    z, x, y = images.shape
+    cols = int(math.ceil(math.sqrt(z)))
+    rows = int(math.ceil(z / float(cols)))
+    gap = max(6, x // 4)
+
+    vmin, vmax = np.nanmin(images), np.nanmax(images)
+    rgb = cm.viridis((images - vmin) / max(vmax - vmin, 1e-12))[..., :3]
+    rgb[np.isnan(images)] = 1
+    rgb[:, edges] = 0.9
+
+    montage = np.ones((rows*(x + gap), cols*y, 3))
+    for zslice in range(z):
+        top, left = (zslice // cols)*(x + gap) + gap, (zslice % cols)*y
+        montage[top:top + x, left:left + y] = rgb[zslice]
+
+    fig = Figure(figsize=(1.5*cols, 1.6*rows + 0.5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1 - 0.5/(1.6*rows + 0.5)])
+    ax.imshow(montage, interpolation='nearest', aspect='auto')
+    for zslice in range(z):
+        colour = 'red' if artifact[zslice] else 'green' if signal[zslice] else 'black'
+        ax.text((zslice % cols)*y + y/2., (zslice // cols)*(x + gap) + gap/2., "{}: m{} l{}".format(zslice + 1, mid_counts[zslice], lo_counts[zslice]),
+                fontsize=8, color=colour, ha='center', va='center')
+    ax.axis('off')
+
+    fig.suptitle("Component {}: {} points, {}".format(comp, points, "flagged for removal" if flagged else "kept"), color='red' if flagged else 'black')
+    fig.savefig(path, dpi=72)
+
+    return(os.path.basename(path))
+
+# render a montage per component of one classification into qc_dir and write its summary.json and index.html. Components are rendered by jobs worker processes, a few at a time so that only their images are held in memory. Returns the summary
+def render(qc_dir, mid_comp, lo_comp, results, shape, label, jobs=1):
+
+    x, y = shape[:2]
+    comps = len(results.flags)
+    edges = mask_outlines(x, y)
+    artifact, signal = check_slices.slice_rules(results.mid_counts, results.lo_counts)
+
+    if not os.path.isdir(qc_dir):
+        os.makedirs(qc_dir)
+
+    def components():
+        step = check_slices.COMPS_PER_CHUNK
+        for first in range(0, comps, step):
+            last = min(first + step, comps)
+            images = spectra_images(mid_comp, lo_comp, x, y, first, last)
+            for comp in range(first, last):
+                yield (images[comp - first], comp + 1, int(results.points[comp]), bool(results.flags[comp]),
+                       results.mid_counts[comp], results.lo_counts[comp], artifact[comp], signal[comp], edges,
+                       os.path.join(qc_dir, 'comp_{:03d}.png'.format(comp + 1)))
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pngs = list(pool.imap(render_component, components()))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        pngs = [render_component(job) for job in components()]
+
+    summary = {'label': label,
+               'components': [{'comp': comp + 1, 'points': int(results.points[comp]), 'flagged': bool(results.flags[comp]), 'image': pngs[comp]}
+                              for comp in range(comps)]}
+    with open(os.path.join(qc_dir, SUMMARY_NAME), 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    write_index(qc_dir, label)
+
+    return(summary)
+
+# html section with a thumbnail of every component of one run. prefix is the path of the run's images relative to the page
+def run_section(summary, prefix):
+
+    flagged = [str(entry['comp']) for entry in summary['components'] if entry['flagged']]
+    cells = []
+    for entry in summary['components']:
+        image = prefix + entry['image']
+        border = 'red' if entry['flagged'] else '#ccc'
+        cells.append('<a href="{0}"><img src="{0}" width="240" title="component {1}: {2} points" style="border: 3px solid {3}"></a>'.format(image, entry['comp'], entry['points'], border))
+
+    return('<h2>{}</h2>\n<p>Flagged for removal: [{}]</p>\n<div>\n{}\n</div>\n'.format(summary['label'], ','.join(flagged), '\n'.join(cells)))
+
+# write index.html in qc_dir for the run rendered there, if any, and for every run folder directly below it. Written under a temporary name and renamed, so runs finishing at the same time never leave a partial page
+def write_index(qc_dir, title):
+
+    sections = []
+    for name in [''] + sorted(os.listdir(qc_dir)):
+        summaryfile = os.path.join(qc_dir, name, SUMMARY_NAME)
+        if os.path.isfile(summaryfile):
+            with open(summaryfile) as f:
+                sections.append(run_section(json.load(f), name + '/' if name else ''))
+
+    page = '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>FeenICS QC: {0}</title></head>\n<body>\n<h1>FeenICS QC: {0}</h1>\n{1}</body>\n</html>\n'.format(title, '\n'.join(sections))
+
+    handle, partial = tempfile.mkstemp(dir=qc_dir, suffix='.html')
+    with os.fdopen(handle, 'w') as f:
+        f.write(page)
+    os.chmod(partial, 0o644)
+    os.rename(partial, os.path.join(qc_dir, INDEX_NAME))
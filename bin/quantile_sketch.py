@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Mergeable per slice quantile sketches of the weighted masked power values check_slices takes its thresholds from.
+
+Usage:
+    quantile_sketch.py -o <output> <sketch or directory> ...
+
+Arguments:
+    <sketch or directory>   run sketch files written by check_slices.py --sketch, or experiment directories, whose
+                            <subject>/<sprl>/fix4melview_Standard_thr20_sketch.npz files are all used
+
+Options:
+    -o, --output            file to write the merged sketch to, for check_slices.py and s2_identify_components.py --pooled
+
+Each slice's values are counted in a histogram of logarithmic buckets, bucket i holding the values in
+(gamma^(i-1), gamma^i] with gamma = (1 + alpha) / (1 - alpha). Reporting a bucket by 2 gamma^i / (gamma + 1) is within a
+relative error of alpha of every value in it, so any quantile read from the sketch is within alpha (relative) of the
+exact quantile. The buckets are fixed (values from MIN_VALUE to MAX_VALUE, smaller values counting as 0), so sketches
+are merged by adding their counts: merging run sketches gives exactly the sketch of all their values together, in
+any order, without holding any spectrum. A sketch of a run is two (slices, buckets) count arrays, for the mid and lo
+frequency values, and is stored as a compressed .npz file (about 90 kB for 20 slices of 64x64 components).
+"""
+
+import argparse
+import glob
+import os
+import numpy as np
+
+# relative accuracy of the quantiles
+DEFAULT_ALPHA = 0.002
+
+# range of values given their own buckets. Masked power values of melodic_IC spectra lie well within it
+MIN_VALUE = 1e-6
+MAX_VALUE = 1e14
+
+SKETCH_NAME = 'fix4melview_Standard_thr20_sketch.npz'
+
+parser = argparse.ArgumentParser(description="Merge per run quantile sketches into one, for pooled thresholds across a study or site")
+parser.add_argument("-o", "--output", required=True, help="file to write the merged sketch to")
+parser.add_argument("inputs", nargs='+', help="run sketch files, or experiment directories whose run sketches are all merged")
+
+class SliceSketch(object):
+    """
+    Log bucket histograms of the values of every slice. counts has shape
+    (slices, buckets + 1); column 0 counts values below MIN_VALUE (taken as
+    0), column j > 0 counts the values of bucket offset + j - 1.
+    """
+
+    def __init__(self, slices, alpha=DEFAULT_ALPHA, counts=None):
+        self.alpha = float(alpha)
+        self.gamma = (1 + self.alpha) / (1 - self.alpha)
+        self.offset = int(np.ceil(np.log(MIN_VALUE) / np.log(self.gamma)))
+        buckets = int(np.ceil(np.log(MAX_VALUE) / np.log(self.gamma))) - self.offset + 1
+        self.counts = np.zeros((slices, buckets + 1), dtype=np.int64) if counts is None else counts
+
+    # count the values of one slice
+    def add(self, zslice, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        columns = np.zeros(values.shape, dtype=np.int64)
+        positive = values >= MIN_VALUE
+        columns[positive] = np.ceil(np.log(values[positive]) / np.log(self.gamma)).astype(np.int64) - self.offset + 1
+        np.clip(columns, 0, self.counts.shape[1] - 1, out=columns)
+        self.counts[zslice] += np.bincount(columns, minlength=self.counts.shape[1])
+
+    # add the counts of another sketch of the same slices and accuracy
+    def merge(self, other):
+        if other.counts.shape != self.counts.shape or other.alpha != self.alpha:
+            raise ValueError("cannot merge sketches of {} slices (alpha {}) with {} slices (alpha {})".format(
+                other.counts.shape[0], other.alpha, self.counts.shape[0], self.alpha))
+        self.counts += other.counts
+
+    # the value reported for each column of counts
+    def values(self):
+        index = np.arange(self.offset, self.offset + self.counts.shape[1] - 1)
+        return(np.concatenate([[0.], 2 * self.gamma**index / (self.gamma + 1)]))
+
+    # (len(percents), slices) array of the percentiles of every slice, interpolated between ranks as np.percentile does
+    def percentiles(self, percents):
+        values = self.values()
+        totals = self.counts.sum(axis=1)
+        result = np.empty((len(percents), self.counts.shape[0]))
+        for zslice in range(self.counts.shape[0]):
+            if totals[zslice] == 0:
+                raise ValueError("no values in slice {} of the sketch".format(zslice + 1))
+            cumulative = np.cumsum(self.counts[zslice])
+            for n, percent in enumerate(percents):
+                rank = (totals[zslice] - 1) * percent / 100.
+                below, above = values[np.searchsorted(cumulative, [np.floor(rank), np.ceil(rank)], side='right')]
+                result[n, zslice] = below + (rank - np.floor(rank)) * (above - below)
+        return(result)
+
+# write the mid and lo sketches of a run (or of several merged) to a compressed numpy archive
+def save(path, mid, lo):
+    np.savez_compressed(path, alpha=mid.alpha, mid=mid.counts, lo=lo.counts)
+
+# read the mid and lo sketches written by save
+def load(path):
+    with np.load(path) as archive:
+        alpha = float(archive['alpha'])
+        return(SliceSketch(archive['mid'].shape[0], alpha, archive['mid']), SliceSketch(archive['lo'].shape[0], alpha, archive['lo']))
+
+# the run sketch files given directly or found in experiment directories
+def sketch_files(inputs):
+
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, '*', 'sprl*', SKETCH_NAME))))
+        else:
+            paths.append(path)
+
+    return(paths)
+
+# merge the sketches of all inputs and write them to output. Returns the number of sketches merged
+def main(inputs, output):
+
+    paths = sketch_files(inputs)
+    if not paths:
+        raise IOError("no sketch files found in {}".format(', '.join(inputs)))
+
+    mid, lo = load(paths[0])
+    for path in paths[1:]:
+        run_mid, run_lo = load(path)
+        mid.merge(run_mid)
+        lo.merge(run_lo)
+
+    save(output, mid, lo)
+    print("Merged {} sketches of {} values per slice into {}".format(len(paths), int(mid.counts[0].sum()), output))
+
+    return(len(paths))
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    main(args.inputs, args.output)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Regresses ICA components out of a 4D image in this process, without FSL.
+
+Equivalent to the default (non-aggressive) mode of
+    fsl_regfilt -i data -d melodic_mix -f "list" -o out
+Both the data and the mixing matrix are demeaned over time, the full mixing
+matrix is fitted to every voxel's time course by least squares
+(betas = pinv(mix) * data), and only the fitted contribution of the listed
+components, mix[:, list] * betas[list], is subtracted. The component time
+courses are not orthogonal, so the part of the data shared between noise and
+signal components is kept, unlike fsl_regfilt -a. The temporal mean of each
+voxel is kept, and the result is written as float32.
+
+The image is never held in memory. The betas are linear in the data, so a
+first pass over blocks of volumes adds up betas = pinv(mix) * data and each
+voxel's temporal sum (subtracting the contribution of the mean afterwards
+gives the betas of the demeaned data), and a second pass writes the cleaned
+image block by block. Apart from the betas, 8 bytes per voxel per removed
+component, memory is bounded by mem_budget, whatever the number of volumes.
+Differences from fsl_regfilt are at float32 rounding level.
+
+Usage:
+    regress.py <data> <melodic_mix> <components> <output>
+
+Arguments:
+    <data>              4D nifti image (e.g. filtered_func_data.nii.gz)
+    <melodic_mix>       text file of component time courses, one row per volume
+    <components>        comma separated list of components to remove, counting from 1 (e.g. "1,4,7")
+    <output>            path of the cleaned image
+
+Options:
+    --memBudget MB      memory to use for each block of volumes. Default is 64
+"""
+
+import argparse
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import seek_tell
+
+# MB used for each block of volumes when no budget is given
+DEFAULT_MEM_BUDGET = 64
+
+# number of volumes to read at once so that a block (as read, as float64 and the fitted noise) stays within mem_budget MB
+def volumes_per_block(voxels, mem_budget=None):
+
+    if mem_budget is None:
+        mem_budget = DEFAULT_MEM_BUDGET
+    return(max(1, int(mem_budget * 2**20 // (voxels * 8 * 3))))
+
+# read a text mixing matrix, one row per volume and one column per component
+def load_mix(mixfile):
+
+    mix = np.loadtxt(mixfile, ndmin=2)
+    return(mix)
+
+# (unmix, noise) for removing components (numbered from 1, as for fsl_regfilt -f): the rows of pinv(mix) giving their betas, and their time courses, both from the demeaned mixing matrix
+def regressors(mix, components, timepoints):
+
+    if mix.shape[0] != timepoints:
+        raise ValueError("melodic_mix has {} rows but the data has {} volumes".format(mix.shape[0], timepoints))
+
+    flagged = np.asarray(components, dtype=int) - 1
+    if np.any(flagged < 0) or np.any(flagged >= mix.shape[1]):
+        raise ValueError("components must be between 1 and {}, got {}".format(mix.shape[1], list(components)))
+
+    design = mix - mix.mean(axis=0)
+    return(np.linalg.pinv(design)[flagged], design[:, flagged])
+
+# volumes start to stop of img as a (voxels, volumes) float32 array. nifti data is stored with x varying fastest, so in fortran order this is a view of the block read
+def read_block(img, start, stop):
+
+    block = np.asarray(img.dataobj[..., start:stop], dtype=np.float32)
+    return(block.reshape((-1, stop - start), order='F'))
+
+# fsl_regfilt -i infile -d mixfile -f components -o outfile, without FSL
+def regfilt(infile, mixfile, components, outfile, mem_budget=None):
+
+    # keep the file open, so that a compressed image is decompressed once per pass rather than once per block
+    img = nib.load(infile, keep_file_open=True)
+    shape = img.shape
+    timepoints = shape[-1]
+    voxels = int(np.prod(shape[:-1]))
+    unmix, noise = regressors(load_mix(mixfile), components, timepoints)
+    step = volumes_per_block(voxels, mem_budget)
+
+    # first pass: betas of the demeaned data, unmix * (data - mean) = unmix * data - (unmix * 1) mean
+    betas = np.zeros((len(unmix), voxels))
+    total = np.zeros(voxels)
+    for start in range(0, timepoints, step):
+        stop = min(start + step, timepoints)
+        block = read_block(img, start, stop).astype(np.float64)
+        betas += np.dot(unmix[:, start:stop], block.T)
+        total += block.sum(axis=1)
+    betas -= np.outer(unmix.sum(axis=1), total / timepoints)
+
+    # the header of the float32 output, set up as nib.save would without holding the data
+    out = nib.Nifti1Image(np.broadcast_to(np.float32(0), shape), img.affine, img.header)
+    out.set_data_dtype(np.float32)
+    out.update_header()
+    header = out.header
+    header.set_slope_inter(1, 0)
+    dtype = header.get_data_dtype()
+
+    # second pass: write the cleaned volumes block by block after the header
+    with ImageOpener(outfile, 'wb') as f:
+        header.write_to(f)
+        seek_tell(f, header.get_data_offset(), write0=True)
+        for start in range(0, timepoints, step):
+            stop = min(start + step, timepoints)
+            block = read_block(img, start, stop).astype(np.float64)
+            block -= np.dot(noise[start:stop], betas).T
+            f.write(block.T.astype(dtype).tobytes())
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Regress ICA components out of a 4D image like fsl_regfilt (non-aggressive), without FSL")
+    parser.add_argument("data", type=str, help="4D nifti image, e.g. filtered_func_data.nii.gz")
+    parser.add_argument("melodic_mix", type=str, help="text file of component time courses, one row per volume")
+    parser.add_argument("components", type=str, help="comma separated list of components to remove, counting from 1")
+    parser.add_argument("output", type=str, help="path of the cleaned image")
+    parser.add_argument("--memBudget", type=float, default=None, help="memory in MB to use for each block of volumes. Default is 64.")
+    args = parser.parse_args()
+
+    components = [int(comp) for comp in args.components.strip('"[]').split(',') if comp.strip()]
+    regfilt(args.data, args.melodic_mix, components, args.output, args.memBudget)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Manifest of classification results, used by s2_identify_components.py to skip
+runs whose results are already up to date.
+
+Each run (subject/sprl) is recorded with a key describing everything its
+results depend on: the identity of the melodic_IC file (size and mtime, or
+size and SHA-1 when hashing is requested), the mid and low factors,
+check_slices.ALGORITHM_VERSION, any non-default fft settings and the pooled
+threshold sketches, if used. A run is reused only if its key matches and the
+output files it wrote are still there, unchanged.
+
+When the work is split into shards (s2_identify_components.py --shard i/N), each
+shard writes its own manifest, feenics_manifest.shard-i-of-N.json, and
+merge_shards combines them into the study manifest.
+"""
+
+import glob
+import hashlib
+import json
+import os, tempfile
+
+import check_slices
+
+MANIFEST_NAME = 'feenics_manifest.json'
+SHARD_MANIFEST_NAME = 'feenics_manifest.shard-{}-of-{}.json'
+
+# describe the melodic_IC file and settings a run's results depend on
+def input_key(melodicfile, midFactor, lowFactor, use_hash=False, pooled=None):
+
+    stat = os.stat(melodicfile)
+    key = {'size': stat.st_size,
+           'midFactor': float(midFactor),
+           'lowFactor': float(lowFactor),
+           'version': check_slices.ALGORITHM_VERSION}
+
+    # results from another fft backend or precision may differ by float32 rounding, so they are keyed too (the number of workers does not change them). The reference settings are left out, so that keys recorded before the fft options existed still match
+    fft = check_slices.fft_settings()
+    if (fft.backend, fft.float32) != ('fftpack', False):
+        key['fft'] = [fft.backend, fft.float32]
+
+    # thresholds from pooled sketches change whenever the sketch file does, so it is identified by content
+    if pooled is not None:
+        key['pooled'] = file_hash(pooled)
+
+    if use_hash:
+        key['sha1'] = file_hash(melodicfile)
+    else:
+        key['mtime'] = stat.st_mtime
+
+    return(key)
+
+def file_hash(path, blocksize=2**20):
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+
+    return(digest.hexdigest())
+
+# size and mtime of each output file, so that edited or deleted outputs are recomputed
+def output_stats(outputs):
+
+    stats = {}
+    for path in outputs:
+        stat = os.stat(path)
+        stats[os.path.basename(path)] = [stat.st_size, stat.st_mtime]
+
+    return(stats)
+
+def load_manifest(path):
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return({'runs': {}, 'failed': {}})
+
+    manifest.setdefault('runs', {})
+    manifest.setdefault('failed', {})
+    return(manifest)
+
+# write under a temporary name and rename, so an interrupted run never leaves a truncated manifest
+def save_manifest(path, manifest):
+
+    handle, partial = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(handle, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(partial, path)
+
+# the recorded entry for run if it was made with the same key and its outputs are unchanged, otherwise None
+def lookup(manifest, run, key, outputs):
+
+    entry = manifest['runs'].get(run)
+    if entry is None or entry.get('key') != key:
+        return(None)
+
+    try:
+        if output_stats(outputs) != entry.get('outputs'):
+            return(None)
+    except OSError:
+        return(None)
+
+    return(entry)
+
+def record(manifest, run, key, outputs, flagged):
+
+    manifest['runs'][run] = {'key': key,
+                             'outputs': output_stats(outputs),
+                             'flagged': list(flagged)}
+    manifest['failed'].pop(run, None)
+
+# note why a run failed. Any earlier results for it are dropped, since its outputs can no longer be trusted
+def record_failure(manifest, run, reason):
+
+    manifest['runs'].pop(run, None)
+    manifest['failed'][run] = reason
+
+# parse a shard specification "i/N" (i from 1 to N) into (i, N)
+def parse_shard(text):
+
+    index, count = [int(part) for part in text.split('/')]
+    if not 1 <= index <= count:
+        raise ValueError("shard must be i/N with 1 <= i <= N, got {}".format(text))
+
+    return(index, count)
+
+# whether run belongs to shard (index, count). Based on a hash of the run name rather than its position in the work list, so adding subjects does not move existing runs to other shards
+def in_shard(run, shard):
+
+    index, count = shard
+    digest = hashlib.md5(run.encode('utf-8')).hexdigest()
+    return(int(digest, 16) % count == index - 1)
+
+# combine the shard manifests in directory into the study manifest. The shard manifests are removed once merged, so that their entries can never override newer results in a later merge. Returns the merged manifest and the shard files that were merged
+def merge_shards(directory):
+
+    manifestfile = os.path.join(directory, MANIFEST_NAME)
+    manifest = load_manifest(manifestfile)
+
+    shardfiles = sorted(glob.glob(os.path.join(directory, SHARD_MANIFEST_NAME.format('*', '*'))))
+    for shardfile in shardfiles:
+        shard = load_manifest(shardfile)
+        for run, entry in shard['runs'].items():
+            manifest['runs'][run] = entry
+            manifest['failed'].pop(run, None)
+        for run, reason in shard['failed'].items():
+            record_failure(manifest, run, reason)
+
+    save_manifest(manifestfile, manifest)
+    for shardfile in shardfiles:
+        os.remove(shardfile)
+
+    return(manifest, shardfiles)
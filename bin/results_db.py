@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Study database of classification results, written by s2_identify_components.py, and queries over it.
+
+Usage:
+    results_db.py [options] <database> <query>
+
+Arguments:
+    <database>          feenics_results.db, or the experiment directory holding it
+    <query>             runs, subjects, thresholds, components, slices or sql
+
+Options:
+    --subject           only this subject (components and slices)
+    --sprl              only this sprl condition, sprlIN or sprlOUT (components and slices)
+    --comp              only this component (slices)
+    --flagged           only flagged components (components)
+    --sql               the statement to run for the sql query
+
+Queries print comma separated rows with a header:
+    runs                subject, sprl, status, comps, slices, number and list of flagged components of every run
+    subjects            number of runs, components and flagged components of every subject
+    thresholds          number of runs and mean, min and max mid and lo thresholds of every slice, across the study
+    components          points and flag of every component
+    slices              mid and lo counts of every slice of every component
+
+The database (SQLite) has one row per run in runs, keyed by subject and sprl, and the thresholds, components and
+slices of each run in tables of those names, referring to it by run_id. Runs are written in batches of BATCH_RUNS
+per transaction as s2 finishes them, so a study is never left half written and an interrupted s2 only loses its
+last batch, which is recomputed on the next call.
+"""
+
+import argparse
+import glob
+import json
+import os, time
+import sqlite3
+import numpy as np
+
+import check_slices
+
+DB_NAME = 'feenics_results.db'
+SHARD_DB_NAME = 'feenics_results.shard-{}-of-{}.db'
+
+# runs written per transaction
+BATCH_RUNS = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    subject TEXT NOT NULL,
+    sprl TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    key TEXT,
+    midFactor REAL,
+    lowFactor REAL,
+    comps INTEGER,
+    slices INTEGER,
+    n_flagged INTEGER,
+    flagged TEXT,
+    recorded REAL,
+    UNIQUE (subject, sprl)
+);
+CREATE TABLE IF NOT EXISTS thresholds (
+    run_id INTEGER NOT NULL,
+    slice INTEGER NOT NULL,
+    mid REAL,
+    lo REAL,
+    PRIMARY KEY (run_id, slice)
+);
+CREATE TABLE IF NOT EXISTS components (
+    run_id INTEGER NOT NULL,
+    comp INTEGER NOT NULL,
+    points INTEGER,
+    flagged INTEGER,
+    PRIMARY KEY (run_id, comp)
+);
+CREATE TABLE IF NOT EXISTS slices (
+    run_id INTEGER NOT NULL,
+    comp INTEGER NOT NULL,
+    slice INTEGER NOT NULL,
+    mid_count INTEGER,
+    lo_count INTEGER,
+    PRIMARY KEY (run_id, comp, slice)
+);
+CREATE INDEX IF NOT EXISTS components_flagged ON components (flagged, run_id);
+"""
+
+QUERIES = {
+    'runs': """SELECT subject, sprl, status, comps, slices, n_flagged, flagged FROM runs ORDER BY subject, sprl""",
+    'subjects': """SELECT subject, count(*) AS runs, sum(comps) AS comps, sum(n_flagged) AS flagged FROM runs WHERE status = 'ok' GROUP BY subject ORDER BY subject""",
+    'thresholds': """SELECT slice, count(*) AS runs, avg(mid) AS mean_mid, min(mid) AS min_mid, max(mid) AS max_mid, avg(lo) AS mean_lo, min(lo) AS min_lo, max(lo) AS max_lo
+                     FROM thresholds GROUP BY slice ORDER BY slice""",
+    'components': """SELECT subject, sprl, comp, points, components.flagged FROM components JOIN runs USING (run_id)
+                     WHERE (:subject IS NULL OR subject = :subject) AND (:sprl IS NULL OR sprl = :sprl) AND (:flagged IS NULL OR components.flagged = :flagged)
+                     ORDER BY subject, sprl, comp""",
+    'slices': """SELECT subject, sprl, comp, slice, mid_count, lo_count, lo_count - mid_count AS difference FROM slices JOIN runs USING (run_id)
+                 WHERE (:subject IS NULL OR subject = :subject) AND (:sprl IS NULL OR sprl = :sprl) AND (:comp IS NULL OR comp = :comp)
+                 ORDER BY subject, sprl, comp, slice""",
+}
+
+parser = argparse.ArgumentParser(description="Query the study database of FeenICS classification results")
+parser.add_argument("--subject", help="only this subject (components and slices queries)")
+parser.add_argument("--sprl", help="only this sprl condition (components and slices queries)")
+parser.add_argument("--comp", type=int, help="only this component (slices query)")
+parser.add_argument("--flagged", action='store_true', help="only flagged components (components query)")
+parser.add_argument("--sql", help="statement to run for the sql query")
+parser.add_argument("database", type=str, help="feenics_results.db, or the experiment directory holding it")
+parser.add_argument("query", choices=sorted(QUERIES) + ['sql'], help="query to run")
+
+# open (creating if needed) the database at path
+def connect(path):
+
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return(conn)
+
+# remove a run and its thresholds, components and slices
+def delete_run(conn, subject, sprl):
+
+    for (run_id,) in conn.execute("SELECT run_id FROM runs WHERE subject = ? AND sprl = ?", (subject, sprl)).fetchall():
+        for table in ['thresholds', 'components', 'slices']:
+            conn.execute("DELETE FROM {} WHERE run_id = ?".format(table), (run_id,))
+        conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+
+# replace the rows of a run with its check_slices.Classification, or with its error if results is None. Does not commit
+def store_run(conn, subject, sprl, key, results, error=None, recorded=None):
+
+    delete_run(conn, subject, sprl)
+    recorded = recorded or time.time()
+
+    if results is None:
+        conn.execute("INSERT INTO runs (subject, sprl, status, error, recorded) VALUES (?, ?, 'failed', ?, ?)", (subject, sprl, error, recorded))
+        return
+
+    comps, z = results.mid_counts.shape
+    flagged = check_slices.noise_components(results.flags)
+    cursor = conn.execute("INSERT INTO runs (subject, sprl, status, key, midFactor, lowFactor, comps, slices, n_flagged, flagged, recorded) VALUES (?, ?, 'ok', ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (subject, sprl, json.dumps(key, sort_keys=True), key.get('midFactor'), key.get('lowFactor'), comps, z, len(flagged),
+                           '[' + ','.join(map(str, flagged)) + ']', recorded))
+    run_id = cursor.lastrowid
+
+    # numpy scalars are converted to python numbers by tolist, as sqlite3 cannot store them
+    conn.executemany("INSERT INTO thresholds VALUES (?, ?, ?, ?)",
+                     [(run_id, zslice + 1, mid, lo) for zslice, (mid, lo) in enumerate(zip(np.asarray(results.cutoff_mid, dtype=float).tolist(), np.asarray(results.cutoff_lo, dtype=float).tolist()))])
+    conn.executemany("INSERT INTO components VALUES (?, ?, ?, ?)",
+                     [(run_id, comp + 1, points, flag) for comp, (points, flag) in enumerate(zip(results.points.tolist(), results.flags.astype(int).tolist()))])
+    mid_counts, lo_counts = results.mid_counts.tolist(), results.lo_counts.tolist()
+    conn.executemany("INSERT INTO slices VALUES (?, ?, ?, ?, ?)",
+                     [(run_id, comp + 1, zslice + 1, mid_counts[comp][zslice], lo_counts[comp][zslice]) for comp in range(comps) for zslice in range(z)])
+
+# read a run back as (key, Classification, error, recorded). key and Classification are None for a failed run
+def load_run(conn, subject, sprl):
+
+    row = conn.execute("SELECT run_id, key, comps, slices, error, recorded FROM runs WHERE subject = ? AND sprl = ?", (subject, sprl)).fetchone()
+    if row is None:
+        raise KeyError('/'.join([subject, sprl]))
+    run_id, key, comps, z, error, recorded = row
+    if key is None:
+        return(None, None, error, recorded)
+
+    thresholds = np.array(conn.execute("SELECT mid, lo FROM thresholds WHERE run_id = ? ORDER BY slice", (run_id,)).fetchall(), dtype=float).reshape(z, 2)
+    components = np.array(conn.execute("SELECT points, flagged FROM components WHERE run_id = ? ORDER BY comp", (run_id,)).fetchall(), dtype=int).reshape(comps, 2)
+    counts = np.array(conn.execute("SELECT mid_count, lo_count FROM slices WHERE run_id = ? ORDER BY comp, slice", (run_id,)).fetchall(), dtype=int).reshape(comps, z, 2)
+
+    results = check_slices.Classification(thresholds[:, 0], thresholds[:, 1], counts[:, :, 0], counts[:, :, 1], components[:, 0], components[:, 1].astype(bool))
+    return(json.loads(key), results, error, recorded)
+
+# {(subject, sprl): key} of the runs with results in the database at path, which is only read
+def recorded_keys(path):
+
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT subject, sprl, key FROM runs WHERE status = 'ok'").fetchall()
+    except sqlite3.OperationalError:
+        # no runs table yet
+        rows = []
+    finally:
+        conn.close()
+
+    return(dict(((subject, sprl), key) for subject, sprl, key in rows))
+
+class ResultsWriter(object):
+    """
+    Writes the results of s2 to a study database as runs finish, BATCH_RUNS
+    runs per transaction. Only the process running s2 writes, never its
+    worker processes, so there is a single writer. A shard writes its own
+    database, but also counts the runs of the study database (only read) as
+    recorded, as the shard manifest is seeded from the study manifest.
+    """
+
+    def __init__(self, path, batch=BATCH_RUNS, study=None):
+        self.conn = connect(path)
+        self.batch = batch
+        self.pending = []
+        self.keys = {}
+        if study is not None and os.path.exists(study):
+            self.keys.update(recorded_keys(study))
+        self.keys.update(recorded_keys(path))
+
+    # whether the database holds results of run made with key
+    def matches(self, subject, sprl, key):
+        return(self.keys.get((subject, sprl)) == json.dumps(key, sort_keys=True))
+
+    def add(self, subject, sprl, key, results):
+        self.pending.append((subject, sprl, key, results, None))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def add_failure(self, subject, sprl, error):
+        self.pending.append((subject, sprl, None, None, error))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    # write the pending runs in one transaction
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            for subject, sprl, key, results, error in self.pending:
+                store_run(self.conn, subject, sprl, key, results, error)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# combine the shard databases in directory into the study database, in one transaction, and remove them. Returns the shard files that were merged
+def merge_shards(directory):
+
+    shardfiles = sorted(glob.glob(os.path.join(directory, SHARD_DB_NAME.format('*', '*'))))
+    conn = connect(os.path.join(directory, DB_NAME))
+    with conn:
+        for shardfile in shardfiles:
+            shard = sqlite3.connect(shardfile)
+            for subject, sprl in shard.execute("SELECT subject, sprl FROM runs").fetchall():
+                key, results, error, recorded = load_run(shard, subject, sprl)
+                store_run(conn, subject, sprl, key, results, error, recorded)
+            shard.close()
+    conn.close()
+
+    for shardfile in shardfiles:
+        os.remove(shardfile)
+
+    return(shardfiles)
+
+# run a query, returning the column names and the rows
+def query(database, name, subject=None, sprl=None, comp=None, flagged=False, sql=None):
+
+    if os.path.isdir(database):
+        database = os.path.join(database, DB_NAME)
+    if not os.path.exists(database):
+        raise IOError("no results database at {}".format(database))
+
+    conn = sqlite3.connect(database)
+    try:
+        if name == 'sql':
+            cursor = conn.execute(sql)
+        else:
+            cursor = conn.execute(QUERIES[name], {'subject': subject, 'sprl': sprl, 'comp': comp, 'flagged': 1 if flagged else None})
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description or []]
+    finally:
+        conn.close()
+
+    return(columns, rows)
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    if args.query == 'sql' and not args.sql:
+        parser.error("the sql query needs --sql")
+
+    columns, rows = query(args.database, args.query, args.subject, args.sprl, args.comp, args.flagged, args.sql)
+    print(','.join(columns))
+    for row in rows:
+        print(','.join('"{}"'.format(value) if isinstance(value, str) and ',' in value else str(value) for value in row))
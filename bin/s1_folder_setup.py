@@ -14,37 +14,81 @@ Options:
     -i                      alternative experiment folder containing subjectID subfolders
     -s                      alternative folder containing split spirals
     -p                      to print instuctions for running in parallel (GNU parallel) invoke this option
+    -j                      number of subjects/sprls to run FSL steps for at the same time when running locally. Default is 1
+    --stage                 how to put the spirals in place: copy (default), hardlink, symlink, reflink or auto
 
 
 """
 import argparse
-import os, sys, errno, shutil, fnmatch
-import subprocess
+import os, errno
+import fsl_scheduler
+import staging
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2
+    scandir = None
 
 parser = argparse.ArgumentParser(description="Set up the required file structure and runs FSL Melodic")
 parser.add_argument("-p", "--parallel", action='store_true', help="flag if you would like to run FSL steps on compute cluster in parallel (i.e. scc)")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="number of subjects/sprls to preprocess at the same time when running FSL steps locally. Default is 1.")
 parser.add_argument("-s", "--subs", help="alternative experiment folder containing subjectID subfolders. Use this option if directory does not already contain subjectID subfolders")
 parser.add_argument("-i", "--sprl", help="alternative folder containing split spirals - NOTE: MUST BE CONTAINED WITHIN SUBJECT FOLDER & BE NAMED 'sprlIN.nii' & 'sprlOUT.nii'")
+parser.add_argument("--stage", choices=staging.MODES, default='copy', help="how to put the spirals in the experiment folder: copy, hardlink, symlink, reflink or auto (reflink, else hardlink). Links fall back to copying when they cannot be made, e.g. across filesystems. Default is copy.")
 parser.add_argument("directory", type=str, help="path to top experiment directory. Outputs will be created here.")
 
 args = parser.parse_args()
 
-def find(pattern, path):
-    result = []
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            if fnmatch.fnmatch(name, pattern):
-                result.append(os.path.join(root, name))
-    return result
+# (name, path, is a folder) for each entry of path. scandir gets the file type from the listing itself, without a stat per entry. Symlinked folders are not followed, as with os.walk
+def entries(path):
+
+    if scandir is not None:
+        return([(entry.name, entry.path, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)])
+
+    listing = []
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        listing.append((name, full, os.path.isdir(full) and not os.path.islink(full)))
+    return(listing)
 
-def copy(source, dest):
+# index the files called one of names below each subject folder of root, in a single pass over the tree. Returns {(subject, name): [paths]}. max_depth limits how many folders deep below the subject folder are searched (None for no limit)
+def index_files(root, names, max_depth=None):
+
+    index = {}
+    try:
+        subjects = [(name, path) for name, path, isdir in entries(root) if isdir]
+    except OSError:
+        return(index)
+
+    for subject, path in subjects:
+        pending = [(path, 0)]
+        while pending:
+            path, depth = pending.pop()
+            try:
+                listing = entries(path)
+            except OSError:
+                continue
+            for name, full, isdir in listing:
+                if isdir:
+                    if max_depth is None or depth < max_depth:
+                        pending.append((full, depth + 1))
+                elif name in names:
+                    index.setdefault((subject, name), []).append(full)
+
+    for paths in index.values():
+        paths.sort()
+
+    return(index)
+
+def copy(source, dest, mode='copy'):
     try:
-        shutil.copy(source[0], dest)
-    except:
-        print("File already exists")
+        staging.stage_file(source[0], dest, mode)
+    except (IOError, OSError) as e:
+        print("Could not stage {} in {}: {}".format(source[0], dest, e))
         return
 
-def main(directory, subs, sprl, scc = False):
+def main(directory, subs, sprl, scc = False, jobs = 1, stage = 'copy'):
 
     #  Create file structure required to run FSL Melodic. SubjectID -> sprl* -> T1_brain, sprl*.nii
     try:
@@ -58,23 +102,47 @@ def main(directory, subs, sprl, scc = False):
     # define subfolders
     subfolders = ['sprlIN', 'sprlOUT']
 
-    # only want to read TR once
-    load_worked = False
+    # run folders to preprocess locally
+    runs = []
+
+    # find every spiral in one pass over the input tree, and the spirals already in place in the output tree (subject/sprl*/sprl*.nii)
+    names = ["{}.nii".format(subfolder) for subfolder in subfolders]
+    spirals = index_files(sprl, names)
+    if os.path.abspath(sprl) == os.path.abspath(directory):
+        staged = spirals
+    else:
+        staged = index_files(directory, names, max_depth=1)
+    staged = set(os.path.abspath(path) for paths in staged.values() for path in paths)
+
+    # the spirals to copy for each subject. Copies already in place are not counted as inputs
+    locations = {}
+    missing = []
+    duplicates = []
+    for i in list:
+        for subfolder in subfolders:
+            name = "{}.nii".format(subfolder)
+            dest = os.path.abspath(os.path.join(directory, i, subfolder, name))
+            found = [path for path in spirals.get((i, name), []) if os.path.abspath(path) != dest]
+            locations[i, subfolder] = found
+            if len(found) == 0 and dest not in staged:
+                missing.append("{}, {}".format(i, name))
+            elif len(found) > 1:
+                duplicates.append("{}, {}: {}".format(i, name, ", ".join(found)))
+
+    if missing:
+        print("Could not find {} spiral files:\n  {}".format(len(missing), "\n  ".join(missing)))
+    if duplicates:
+        print("Found more than one copy of {} spiral files, the first listed is used:\n  {}".format(len(duplicates), "\n  ".join(duplicates)))
 
     # iterate through subjects
     for i in list:
-        sprlIN_tf = False
-        sprlOUT_tf = False
 
         # locate the original spirals
-        sprlIN_tf = os.path.exists(os.path.join(directory, i, "sprlIN", "sprlIN.nii"))
-        sprlOUT_tf = os.path.exists(os.path.join(directory, i, "sprlOUT", "sprlOUT.nii"))
-
-        # if sprlIN_tf == False:
-        sprlIN_location = find('sprlIN.nii', os.path.join(sprl, i))
+        sprlIN_tf = os.path.abspath(os.path.join(directory, i, "sprlIN", "sprlIN.nii")) in staged
+        sprlOUT_tf = os.path.abspath(os.path.join(directory, i, "sprlOUT", "sprlOUT.nii")) in staged
 
-        # if sprlOUT_tf == False:
-        sprlOUT_location = find('sprlOUT.nii', os.path.join(sprl, i))
+        sprlIN_location = locations[i, 'sprlIN']
+        sprlOUT_location = locations[i, 'sprlOUT']
 
         # make sprlIN and sprlOUT folders
         for subfolder in subfolders:
@@ -89,60 +157,20 @@ def main(directory, subs, sprl, scc = False):
                 try:
                     print("Copying sprl files for subject {}, {}".format(i, subfolder))
                     if subfolder == 'sprlIN':
-                        copy(sprlIN_location, os.path.join(directory, i, subfolder))
+                        copy(sprlIN_location, os.path.join(directory, i, subfolder), stage)
                     elif subfolder == 'sprlOUT':
-                        copy(sprlOUT_location, os.path.join(directory, i, subfolder))
+                        copy(sprlOUT_location, os.path.join(directory, i, subfolder), stage)
                 except IndexError as e:
                     print("Error copying subject {}: {}".format(i, e))
                     continue
 
-                # to run FSL commands locally
+            # to run FSL commands locally, queue the run folder for the scheduler
             if scc == False:
-                os.chdir(os.path.join(directory, i, subfolder))
-
-                # check if motion corrected file exists, call mcflirt if it does not
-                mc_tf = os.path.exists("motion_corr.nii.gz")
-                if mc_tf == False:
-                    print("Motion correcting {}, {}".format(i, subfolder))
-                    motion_corr_cmd = ["mcflirt", "-in", subfolder, "-refvol","2", "-out", "motion_corr", "-plots"]
-                    try:
-                        p = subprocess.Popen(motion_corr_cmd, stdout=subprocess.PIPE)
-                        p.wait()
-                        if p.returncode != 0:
-                            print("motion correction failed")
-                    except:
-                        print("FSL not on path")
-                        sys.exit(1)
-
-
-                # check if brain extracted file exists, if not call bet
-                bet_tf = os.path.exists("mask_mask.nii.gz")
-                if bet_tf == False:
-                    print("Brain extracting {}, {}".format(i, subfolder))
-                    bet_cmd = ["bet", "motion_corr", "mask", "-f", "0.4", "-m", "-n"]
-                    p = subprocess.Popen(bet_cmd, stdout=subprocess.PIPE)
-                    p.wait()
-                    if p.returncode != 0:
-                        print("brain extraction failed")
-
-                # check if masked file exists, if not call fslmaths
-                mask_tf = os.path.exists("filtered_func_data.nii.gz")
-                if mask_tf == False:
-                    print("Masking {}, {}".format(i, subfolder))
-                    mask_cmd = ["fslmaths", "motion_corr", "-mas", "mask_mask", "filtered_func_data"]
-                    p = subprocess.Popen(mask_cmd, stdout=subprocess.PIPE)
-                    p.wait()
-                    if p.returncode != 0:
-                        print("masking failed")
-
-                # check if melodic_IC file exists, if not call melodic
-                melodic_tf = os.path.exists(os.path.join("filtered_func_data.ica", "melodic_IC.nii.gz"))
-                if melodic_tf == False:
-                    print("Running ICA (melodic) {}, {}. Check filtered_func_data.ica/log.txt for process details".format(i, subfolder))
-                    melodic_cmd = ["melodic", "-i", "filtered_func_data", "-o", "filtered_func_data.ica", "-v", "--nobet", "--bgthreshold=0", "-d", "0", "--report", "--guireport=../../report.html"]
-                    p = subprocess.Popen(melodic_cmd, stdout=open(os.devnull, 'wb'))
-                else:
-                    print("Melodic already run. Remove folder to rerun")
+                runs.append((os.path.join(directory, i, subfolder), subfolder, "{}, {}".format(i, subfolder)))
+
+    # run mcflirt, bet, fslmaths and melodic for each queued run folder, up to jobs folders at a time
+    if scc == False:
+        fsl_scheduler.run_all(runs, jobs)
 
     # to print commands for running FSL in parallel on scc or other computing cluster to terminal
     if scc == True:
@@ -185,4 +213,4 @@ if __name__ == '__main__':
     else:
         scc = False
 
-    main(directory, subs, sprl, scc)
+    main(directory, subs, sprl, scc, args.jobs, args.stage)
@@ -12,44 +12,284 @@ Arguments:
 Options:
     -m, --midFactor     Cutoff multiplier for mid range frequency information. Raise this value to more aggressively remove noise components. Default is 3.
     -l, --lowFactor     Cutoff multiplier for low range frequency information. Raise this value to keep more signal components. Default is 1.
+    -b, --memBudget     Stream each melodic_IC file from disk using roughly this many MB instead of loading it whole.
+    --maskCache         Directory in which to keep the frequency masks for each matrix size, so later runs reuse them.
+    --icCache           Directory in which to keep decompressed, memory mapped copies of the melodic_IC files, so later runs skip decompression.
+    --icCacheLimit      Size limit of the --icCache directory in MB. Default is 4096.
+    --fft               fft implementation: fftpack (default), or scipy or numpy for the faster real input (half spectrum) transform.
+    --fftWorkers        Number of threads for --fft scipy, -1 for every core. Default is 1.
+    --fftFloat32        Transform in single precision.
+    --qc                Render a QC montage of the masked fft of each component of every classified run, with an index.html per subject, to <subject>/qc.
+    --qcJobs            Number of processes rendering the QC images of a run. Default is 1.
+    --npz               Also write the thresholds, per slice counts, points and flags of each run to fix4melview_Standard_thr20.npz.
+    --sketch            Also write the quantile sketches of the thresholds of each run to fix4melview_Standard_thr20_sketch.npz, to be merged by quantile_sketch.py.
+    --pooled            Take the thresholds of every run from the merged quantile sketches in this file instead of the run's own quartiles.
+    --noDb              Do not write the results of each run to the study database, feenics_results.db (see results_db.py).
+    --force             Recompute every run, even those whose results are recorded as up to date in feenics_manifest.json.
+    --hash              Identify melodic_IC files by their content (SHA-1) rather than their size and modification time.
+    -j, --jobs          Number of runs to classify in parallel worker processes. Default is 1.
+    --shard             Only classify shard i of N (e.g. 2/4) of the subject x sprl work list, recording results in feenics_manifest.shard-i-of-N.json.
+    --merge             Combine the shard manifests into feenics_manifest.json, then exit.
+    --timings           Append the wall time and peak memory of each stage of every classified run to this JSON-lines file.
+    --profile           Run cProfile on the runs of this one subject and print the most expensive calls, then exit.
+    --sweepMid          Comma separated midFactors to sweep. Classifies every run for each midFactor/lowFactor pair and writes the flagged components to feenics_sweep.csv instead of the per run classification files.
+    --sweepLow          Comma separated lowFactors to sweep. Defaults to the lowFactor if only --sweepMid is given (and vice versa).
 
 """
 
 import argparse
-import os, sys
+import cProfile, pstats
+import multiprocessing
+import os
 import check_slices
+import instrument
+import quantile_sketch
+import result_cache
+import results_db
 
 parser = argparse.ArgumentParser(description="Remove sprl noise components from all subjects in run folder")
 
 parser.add_argument("-m", "--midFactor", help="cutoff factor for mid/high frequency -noise. Increase to remove more 'noise' components. Default is 3.")
 parser.add_argument("-l", "--lowFactor", help="cutoff factor for low frequency -signal. Increase to remove more 'signal' components. Default is 1.")
+parser.add_argument("-b", "--memBudget", type=float, help="stream each melodic_IC file from disk using roughly this many MB instead of loading it whole. Use for large volumes.")
+parser.add_argument("--maskCache", help="directory in which to keep the frequency masks for each matrix size, so later runs reuse them. Same as setting FEENICS_MASK_CACHE.")
+parser.add_argument("--icCache", help="directory in which to keep decompressed, memory mapped copies of the melodic_IC files, so later runs (e.g. tuning factors) skip decompression. Same as setting FEENICS_IC_CACHE.")
+parser.add_argument("--icCacheLimit", type=float, help="size limit of the --icCache directory in MB, least recently used files are removed first. Same as setting FEENICS_IC_CACHE_MB. Default is 4096.")
+parser.add_argument("--fft", choices=check_slices.FFT_BACKENDS, help="fft implementation. fftpack (default) computes the full complex spectrum; scipy (scipy >= 1.4) and numpy compute only the half spectrum of the real components, which is faster and matches fftpack to float32 rounding.")
+parser.add_argument("--fftWorkers", type=int, help="number of threads for --fft scipy, -1 for every core. Default is 1.")
+parser.add_argument("--fftFloat32", action='store_true', help="transform in single precision, even for float64 melodic_IC files")
+parser.add_argument("--qc", action='store_true', help="render a QC montage of the masked fft of every slice of each component of every classified run to <subject>/qc/<sprl>, and an index.html for each subject in <subject>/qc")
+parser.add_argument("--qcJobs", type=int, default=1, help="number of processes rendering the QC images of a run. With --jobs, each worker renders its own runs. Default is 1.")
+parser.add_argument("--npz", action='store_true', help="also write the thresholds, per slice counts, points and flags of each run to a .npz file next to the classification file")
+parser.add_argument("--sketch", action='store_true', help="also write the quantile sketches of the weighted mid and lo values of every slice of each run to a _sketch.npz file next to the classification file, for pooling with quantile_sketch.py")
+parser.add_argument("--pooled", help="take the thresholds of every run from the merged quantile sketches in this file (written by quantile_sketch.py) instead of the run's own quartiles")
+parser.add_argument("--noDb", action='store_true', help="do not write the thresholds, per slice counts, points and flags of each run to the study database feenics_results.db")
+parser.add_argument("--force", action='store_true', help="recompute every run, even if its results are up to date")
+parser.add_argument("--hash", action='store_true', help="identify melodic_IC files by content hash instead of size and modification time")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="number of runs to classify in parallel worker processes. Default is 1.")
+parser.add_argument("--shard", help="only classify shard i of N of the runs, given as i/N (e.g. 2/4), for spreading the work across nodes")
+parser.add_argument("--merge", action='store_true', help="combine the per shard manifests into the study manifest and exit")
+parser.add_argument("--timings", help="append the wall time and peak memory of each stage (load, fft, mask, thresholds, count, score, write) of every classified run to this JSON-lines file")
+parser.add_argument("--profile", metavar="SUBJECT", help="run cProfile on the sprlIN and sprlOUT runs of this subject, print the most expensive calls and save the stats next to its classification files")
+parser.add_argument("--sweepMid", help="comma separated midFactors to sweep, e.g. 2,3,4. Writes feenics_sweep.csv in the experiment directory instead of the per run classification files.")
+parser.add_argument("--sweepLow", help="comma separated lowFactors to sweep, e.g. 0.5,1. Defaults to the lowFactor if only --sweepMid is given (and vice versa).")
 parser.add_argument("directory", type=str, help="path to top experiment directory")
-args = parser.parse_args()
 
-def main(midFactor, lowFactor, directory):
+# the (subject, sprl) runs of an experiment directory, in a stable order
+def work_list(directory):
 
-    list_subs = os.listdir(directory)
+    list_subs = sorted(i for i in os.listdir(directory) if os.path.isdir(os.path.join(directory, i)))
     subfolders = ["sprlIN", "sprlOUT"]
+
+    return([(i, sprl) for i in list_subs for sprl in subfolders])
+
+# folder of the QC images of one run, below the subject's QC folder that holds its index.html
+def qc_folder(directory, i, sprl=''):
+    return(os.path.join(directory, i, 'qc', sprl))
+
+# classify a single run. Runs in a worker process when --jobs is used, so any error is caught and returned with the run rather than raised. Returns the check_slices.Classification of the run, or the error. When timed, the stage timings of the run are returned too, otherwise None
+def identify_run(job):
+
+    i, sprl, melodicfile, outputcsv, outputnpz, midFactor, lowFactor, mem_budget, timed, qc_dir, qc_jobs, outputsketch, pooled = job
+    timer = instrument.StageTimer(subject=i, sprl=sprl, midFactor=midFactor, lowFactor=lowFactor, memBudget=mem_budget) if timed else None
+
+    # worker processes of a pool cannot start a pool of their own, so they render their QC images themselves
+    if multiprocessing.current_process().daemon:
+        qc_jobs = 1
+
+    try:
+        results = check_slices.main(melodicfile, outputcsv, midFactor, lowFactor, mem_budget=mem_budget, output_npz=outputnpz, timer=timer, qc_dir=qc_dir, qc_jobs=qc_jobs,
+                                    output_sketch=outputsketch, pooled=pooled)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+        if timer is not None:
+            timer.info.update(status='failed', error=error)
+        return(i, sprl, False, error, timer and timer.record())
+
+    if timer is not None:
+        timer.info.update(status='ok')
+    return(i, sprl, True, results, timer and timer.record())
+
+def main(midFactor, lowFactor, directory, mem_budget=None, npz=False, force=False, use_hash=False, jobs=1, shard=None, timings=None, qc=False, qc_jobs=1, db=True, sketch=False, pooled=None):
+
     csvfilename = 'fix4melview_Standard_thr20.txt'
+    npzfilename = 'fix4melview_Standard_thr20.npz'
 
     midFactor = float(midFactor)
     lowFactor = float(lowFactor)
 
+    # results recorded by previous runs, used to skip runs that are already up to date. A shard only handles its own runs, and records them in its own manifest so that shards running at the same time never write the same file
+    manifest = result_cache.load_manifest(os.path.join(directory, result_cache.MANIFEST_NAME))
+    runs = work_list(directory)
+    if shard is None:
+        manifestfile = os.path.join(directory, result_cache.MANIFEST_NAME)
+        dbfile = os.path.join(directory, results_db.DB_NAME)
+    else:
+        manifestfile = os.path.join(directory, result_cache.SHARD_MANIFEST_NAME.format(*shard))
+        dbfile = os.path.join(directory, results_db.SHARD_DB_NAME.format(*shard))
+        runs = [(i, sprl) for i, sprl in runs if result_cache.in_shard('/'.join([i, sprl]), shard)]
+        study = manifest
+        manifest = result_cache.load_manifest(manifestfile)
+        for i, sprl in runs:
+            run = '/'.join([i, sprl])
+            if run in study['runs'] and run not in manifest['runs']:
+                manifest['runs'][run] = study['runs'][run]
+        print("Shard {}/{}: {} runs".format(shard[0], shard[1], len(runs)))
+
+    # the study database is written only by this process, a batch of runs at a time as they finish
+    writer = results_db.ResultsWriter(dbfile, study=os.path.join(directory, results_db.DB_NAME)) if db else None
+
+    plan, pending = [], []
+
     # for each subject and each sprl condition (IN or OUT), call check_slices to create .txt file listing comps to be removed
-    for i in list_subs:
-        for sprl in subfolders:
-            melodicfile =  os.path.join(directory, i, sprl, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
-            outputcsv= os.path.join(directory, i, sprl, csvfilename)
-
-            try:
-                print("Identifying components to be removed for {}, {}".format(i, sprl))
-                check_slices.main(melodicfile, outputcsv, midFactor, lowFactor)
-            except Exception:
-                print("Could not find melodic_IC file for {}, {} or Permissions Error".format(i, sprl))
+    for i, sprl in runs:
+        melodicfile =  os.path.join(directory, i, sprl, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
+        outputcsv= os.path.join(directory, i, sprl, csvfilename)
+        outputnpz = os.path.join(directory, i, sprl, npzfilename) if npz else None
+        outputsketch = os.path.join(directory, i, sprl, quantile_sketch.SKETCH_NAME) if sketch else None
+        qc_dir = qc_folder(directory, i, sprl) if qc else None
+        # a run rendered without QC images is recomputed when they are asked for
+        outputs = [outputcsv] + ([outputnpz] if npz else []) + ([os.path.join(qc_dir, 'summary.json')] if qc else []) + ([outputsketch] if sketch else [])
+
+        try:
+            key = result_cache.input_key(melodicfile, midFactor, lowFactor, use_hash, pooled)
+        except (IOError, OSError) as e:
+            plan.append((i, sprl, 'failed', "melodic_IC file not found or not readable ({})".format(e)))
+            continue
+
+        # runs missing from the database (e.g. in the batch an interrupted call never wrote) are recomputed to fill it
+        if not force and result_cache.lookup(manifest, '/'.join([i, sprl]), key, outputs) is not None and (writer is None or writer.matches(i, sprl, key)):
+            plan.append((i, sprl, 'hit', None))
+            continue
+
+        plan.append((i, sprl, 'pending', (key, outputs)))
+        pending.append((i, sprl, melodicfile, outputcsv, outputnpz, midFactor, lowFactor, mem_budget, timings is not None, qc_dir, qc_jobs, outputsketch, pooled))
+
+    # classify the remaining runs, in a pool of worker processes if requested. Everything is reported in work list order, whatever order the workers finish in
+    if jobs > 1 and len(pending) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(pending)))
+        finished = pool.imap(identify_run, pending)
+    else:
+        pool = None
+        finished = (identify_run(job) for job in pending)
+
+    hits, computed, failures = 0, 0, []
+    try:
+        for i, sprl, status, detail in plan:
+            run = '/'.join([i, sprl])
+
+            if status == 'hit':
+                print("Results up to date for {}, {}".format(i, sprl))
+                hits += 1
                 continue
 
+            if status == 'pending':
+                key, outputs = detail
+                i, sprl, success, detail, record = next(finished)
+                if record is not None:
+                    instrument.write_records(timings, [record])
+                if success:
+                    flagged = check_slices.noise_components(detail.flags)
+                    print("Identified components to be removed for {}, {}: [{}]".format(i, sprl, ','.join(map(str, flagged))))
+                    if writer is not None:
+                        writer.add(i, sprl, key, detail)
+                    result_cache.record(manifest, run, key, outputs, flagged)
+                    result_cache.save_manifest(manifestfile, manifest)
+                    computed += 1
+                    continue
+
+            print("Failed {}, {}: {}".format(i, sprl, detail))
+            if writer is not None:
+                writer.add_failure(i, sprl, detail)
+            result_cache.record_failure(manifest, run, detail)
+            failures.append(run)
+    finally:
+        result_cache.save_manifest(manifestfile, manifest)
+        if writer is not None:
+            writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print("{} runs up to date, {} runs (re)computed, {} runs failed".format(hits, computed, len(failures)))
+    for run in failures:
+        print("  failed: {}".format(run))
+
+    # each run wrote the index of its own images, the subject index covers both runs
+    if qc:
+        import qc_report
+        for i in sorted(set(i for i, sprl in runs)):
+            if os.path.isdir(qc_folder(directory, i)):
+                qc_report.write_index(qc_folder(directory, i), i)
+
+    return(failures)
+
+# profile the classification of both runs of one subject, printing the most expensive calls and saving the full stats to <run>/feenics_profile.prof
+def profile(midFactor, lowFactor, directory, subject, mem_budget=None):
+
+    for sprl in ["sprlIN", "sprlOUT"]:
+        melodicfile =  os.path.join(directory, subject, sprl, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
+        outputcsv = os.path.join(directory, subject, sprl, 'fix4melview_Standard_thr20.txt')
+        statsfile = os.path.join(directory, subject, sprl, 'feenics_profile.prof')
+
+        if not os.path.exists(melodicfile):
+            print("No melodic_IC file for {}, {}".format(subject, sprl))
+            continue
+
+        print("Profiling {}, {}".format(subject, sprl))
+        profiler = cProfile.Profile()
+        profiler.runcall(check_slices.main, melodicfile, outputcsv, float(midFactor), float(lowFactor), mem_budget=mem_budget)
+        profiler.dump_stats(statsfile)
+        pstats.Stats(statsfile).sort_stats('cumulative').print_stats(25)
+
+# combine the results of every shard into the study manifest, and report the runs that failed or were never classified
+def merge(directory):
+
+    manifest, shardfiles = result_cache.merge_shards(directory)
+    dbfiles = results_db.merge_shards(directory)
+
+    runs = ['/'.join(run) for run in work_list(directory)]
+    missing = [run for run in runs if run not in manifest['runs'] and run not in manifest['failed']]
+
+    print("Merged {} shard manifests into {}".format(len(shardfiles), result_cache.MANIFEST_NAME))
+    if dbfiles:
+        print("Merged {} shard databases into {}".format(len(dbfiles), results_db.DB_NAME))
+    print("{} runs classified, {} runs failed, {} runs not yet classified".format(len(manifest['runs']), len(manifest['failed']), len(missing)))
+    for run in sorted(manifest['failed']):
+        print("  failed: {}: {}".format(run, manifest['failed'][run]))
+    for run in missing:
+        print("  not classified: {}".format(run))
+
+# for each subject and sprl condition, classify the components for every pair of factors in one pass over the melodic_IC file, and write the flagged components of every pair to a single table
+def sweep(midFactors, lowFactors, directory, mem_budget=None):
+
+    sweepfilename = 'feenics_sweep.csv'
+
+    factor_pairs = [(float(midFactor), float(lowFactor)) for midFactor in midFactors for lowFactor in lowFactors]
+
+    rows = []
+    for i, sprl in work_list(directory):
+        melodicfile =  os.path.join(directory, i, sprl, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
+
+        try:
+            print("Sweeping {} factor pairs for {}, {}".format(len(factor_pairs), i, sprl))
+            results = check_slices.sweep(melodicfile, factor_pairs, mem_budget)
+        except Exception as e:
+            print("Failed {}, {}: {}: {}".format(i, sprl, type(e).__name__, e))
+            continue
+
+        for midFactor, lowFactor, noise_comps in results:
+            rows.append('{},{},{},{},"[{}]"'.format(i, sprl, midFactor, lowFactor, ','.join(map(str, noise_comps))))
+
+    with open(os.path.join(directory, sweepfilename), 'w') as f:
+        f.write("subject,sprl,midFactor,lowFactor,flagged\n")
+        for row in rows:
+            f.write(row + '\n')
+
 if __name__ == '__main__':
 
+    args = parser.parse_args()
+
     if args.midFactor:
         midFactor = args.midFactor
     else:
@@ -62,4 +302,26 @@ if __name__ == '__main__':
 
     directory = args.directory
 
-    main(midFactor, lowFactor, directory)
+    if args.pooled and not os.path.isfile(args.pooled):
+        parser.error("no pooled sketch file {}".format(args.pooled))
+
+    # check_slices reads the cache locations from the environment
+    if args.maskCache:
+        os.environ['FEENICS_MASK_CACHE'] = args.maskCache
+    if args.icCache:
+        os.environ['FEENICS_IC_CACHE'] = args.icCache
+    if args.icCacheLimit:
+        os.environ['FEENICS_IC_CACHE_MB'] = str(args.icCacheLimit)
+    check_slices.set_fft_options(args.fft, args.fftWorkers, args.fftFloat32)
+
+    if args.merge:
+        merge(directory)
+    elif args.profile:
+        profile(midFactor, lowFactor, directory, args.profile, args.memBudget)
+    elif args.sweepMid or args.sweepLow:
+        midFactors = args.sweepMid.split(',') if args.sweepMid else [midFactor]
+        lowFactors = args.sweepLow.split(',') if args.sweepLow else [lowFactor]
+        sweep(midFactors, lowFactors, directory, args.memBudget)
+    else:
+        shard = result_cache.parse_shard(args.shard) if args.shard else None
+        main(midFactor, lowFactor, directory, args.memBudget, args.npz, args.force, args.hash, args.jobs, shard, args.timings, args.qc, args.qcJobs, not args.noDb, args.sketch, args.pooled)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Identifies and removes spiral artifact components in a single pass over the study, instead of running s2_identify_components.py and then s3_remove_flagged_components.py.
+
+Usage:
+    s2s3_identify_and_clean.py -m <midFactor> -l <lowFactor> <directory>
+
+Arguments:
+    <directory>         path to top experiment directory
+
+Options:
+    -m, --midFactor     Cutoff multiplier for mid range frequency information. Default is 3.
+    -l, --lowFactor     Cutoff multiplier for low range frequency information. Default is 1.
+    -c, --clean_img     path to desired location of cleaned images
+    --backend           fsl (default) to run fsl_regfilt, or numpy to do the same regression without FSL
+    -b, --memBudget     with --backend numpy, memory in MB for each block of volumes the regression reads
+    --stage             how to create the clean image of runs with no components to remove: copy (default), hardlink, symlink, reflink or auto
+    --prefetch          number of runs whose melodic_IC is loaded ahead of the run being processed. Default is 1
+
+Each run is classified with check_slices, writing fix4melview_Standard_thr20.txt as s2 does, and the flagged components are passed
+straight to the regression rather than read back from that file. While one run is classified and cleaned, a background thread
+decompresses and loads the melodic_IC of the next, so reading and computing overlap.
+
+"""
+
+import argparse
+import os, threading
+import numpy as np
+import nibabel as nib
+import check_slices
+import s2_identify_components
+import s3_remove_flagged_components
+import staging
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+parser = argparse.ArgumentParser(description="Identify and remove sprl noise components from all subjects in run folder in one pass")
+parser.add_argument("-m", "--midFactor", help="cutoff factor for mid/high frequency -noise. Increase to remove more 'noise' components. Default is 3.")
+parser.add_argument("-l", "--lowFactor", help="cutoff factor for low frequency -signal. Increase to remove more 'signal' components. Default is 1.")
+parser.add_argument("-c", "--clean_img", help="alternative output location for cleaned images")
+parser.add_argument("--backend", choices=['fsl', 'numpy'], default='fsl', help="fsl runs fsl_regfilt for each run. numpy does the same (non-aggressive) regression in this process and does not need FSL. Default is fsl.")
+parser.add_argument("-b", "--memBudget", type=float, default=None, help="with --backend numpy, memory in MB for each block of volumes the regression reads; the image is streamed, never held in memory whole. Default is 64.")
+parser.add_argument("--stage", choices=staging.MODES, default='copy', help="how to create the clean image of runs with no components to remove: copy, hardlink, symlink, reflink or auto. Default is copy.")
+parser.add_argument("--prefetch", type=int, default=1, help="number of runs whose melodic_IC is loaded ahead of the run being processed. Each holds a whole decompressed melodic_IC in memory. Default is 1.")
+parser.add_argument("directory", type=str, help="path to top experiment directory")
+
+# load the melodic_IC of each run in turn and put (i, sprl, data) on the loaded queue, or (i, sprl, error) if it cannot be read. Runs in a background thread; the queue is bounded, so the thread waits while it is as many runs ahead as the queue holds
+def load_runs(runs, directory, loaded):
+
+    for i, sprl in runs:
+        melodicfile = os.path.join(directory, i, sprl, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
+        try:
+            data = np.asanyarray(nib.load(melodicfile).dataobj)
+        except Exception as e:
+            data = e
+        loaded.put((i, sprl, data))
+
+def main(midFactor, lowFactor, directory, clean_img, stage='copy', backend='fsl', mem_budget=None, prefetch=1):
+
+    csvfilename = 'fix4melview_Standard_thr20.txt'
+
+    midFactor = float(midFactor)
+    lowFactor = float(lowFactor)
+
+    runs = s2_identify_components.work_list(directory)
+
+    loaded = queue.Queue(maxsize=max(1, prefetch))
+    loader = threading.Thread(target=load_runs, args=(runs, directory, loaded))
+    loader.daemon = True
+    loader.start()
+
+    cleaned, copied, failures = [], [], []
+    for _ in runs:
+        i, sprl, data = loaded.get()
+        run = '/'.join([i, sprl])
+
+        if isinstance(data, Exception):
+            print("Failed {}, {}: melodic_IC file not found or not readable ({}: {})".format(i, sprl, type(data).__name__, data))
+            failures.append(run)
+            continue
+
+        # classify, keeping the flagged components for the regression
+        try:
+            results = check_slices.main(data, os.path.join(directory, i, sprl, csvfilename), midFactor, lowFactor)
+        except Exception as e:
+            print("Failed {}, {}: {}: {}".format(i, sprl, type(e).__name__, e))
+            failures.append(run)
+            continue
+        del data
+
+        flagged = check_slices.noise_components(results.flags)
+        print("Identified components to be removed for {}, {}: [{}]".format(i, sprl, ','.join(map(str, flagged))))
+
+        i, sprl, status, detail = s3_remove_flagged_components.remove_components(flagged, clean_img, directory, i, sprl, stage, backend, mem_budget)
+        if status == 'cleaned':
+            print("Removed components from {}, {}".format(i, sprl))
+            cleaned.append(run)
+        elif status == 'copied':
+            print("No components to remove from {}, {}: filtered_func_data staged ({})".format(i, sprl, detail))
+            copied.append(run)
+        else:
+            print("Failed {}, {}: {}".format(i, sprl, detail))
+            failures.append(run)
+
+    loader.join()
+
+    print("{} runs cleaned, {} runs copied, {} runs failed".format(len(cleaned), len(copied), len(failures)))
+    for run in failures:
+        print("  failed: {}".format(run))
+
+    return(failures)
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    if args.midFactor:
+        midFactor = args.midFactor
+    else:
+        midFactor = 3
+
+    if args.lowFactor:
+        lowFactor = args.lowFactor
+    else:
+        lowFactor = 1
+
+    directory = args.directory
+
+    if args.clean_img:
+        clean_img = args.clean_img
+    else:
+        clean_img = args.directory
+
+    main(midFactor, lowFactor, directory, clean_img, args.stage, args.backend, args.memBudget, args.prefetch)
@@ -12,85 +12,142 @@ Arguments:
 Options:
     -c, --clean_img      path to desired location of cleaned images
     -o, --output         if csv outputs were generated in non-default location, identify path to this location
+    --backend            fsl (default) to run fsl_regfilt, or numpy to do the same regression without FSL
+    -b, --memBudget      with --backend numpy, memory in MB for each block of volumes the regression reads
+    --stage              how to create the clean image of runs with no components to remove: copy (default), hardlink, symlink, reflink or auto
+    -j, --jobs           number of runs to clean at the same time, in worker processes. Default is 1
 
 """
 
 import argparse
-import os, sys
+import multiprocessing
+import os
 from subprocess import call
+import regress
+import staging
 
-parser = argparse.ArgumentParser(description="Regresses out identified components using fsl_regfilt. REQUIRES FSL!")
+parser = argparse.ArgumentParser(description="Regresses out identified components using fsl_regfilt (REQUIRES FSL), or without FSL using --backend numpy")
 parser.add_argument("-c", "--clean_img", help="alternative output location for cleaned images")
 parser.add_argument("-o", "--output", help="specify location of .csv slice identification files if these were generated in non-default location")
+parser.add_argument("--stage", choices=staging.MODES, default='copy', help="how to create the clean image of runs with no components to remove, which is filtered_func_data unchanged: copy, hardlink, symlink, reflink or auto (reflink, else hardlink). Links fall back to copying when they cannot be made. Default is copy.")
+parser.add_argument("--backend", choices=['fsl', 'numpy'], default='fsl', help="fsl runs fsl_regfilt for each run. numpy does the same (non-aggressive) regression in this process and does not need FSL. Default is fsl.")
+parser.add_argument("-b", "--memBudget", type=float, default=None, help="with --backend numpy, memory in MB for each block of volumes the regression reads; the image is streamed, never held in memory whole. Default is 64.")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="number of runs to clean at the same time, in worker processes. Default is 1.")
 parser.add_argument("directory", type=str, help="path to top experiment directory")
-args = parser.parse_args()
 
-# this function reads the slices to be removed to a string, and submits to the reg_filt function
+# the components to remove, from the last line of a classification file, e.g. "[1,4,7]" -> [1, 4, 7]
+def read_flagged(csv):
 
-def regfilt(csv, clean_img, directory, i, sprl):
+    with open(csv) as file:
+        slices = file.readlines()[-1]
 
-    slices2remove = []
-    filename = []
+    return([int(comp) for comp in slices.strip().strip('[]').split(',') if comp.strip()])
 
-# Open the final removal file; the last line contains the components to be removed
+# regress the components listed in csv out of one run, writing <clean_img>/<i>.<sprl>.denoised.nii.gz. Only absolute paths are used, so runs can be cleaned at the same time or from other programs. Returns (i, sprl, status, detail) as remove_components does
+def regfilt(csv, clean_img, directory, i, sprl, stage='copy', backend='fsl', mem_budget=None):
+
+    # the last line of the classification file contains the components to be removed
     try:
-        print("Removing components from {}, {}".format(i, sprl))
-        with open(csv) as file:
-            slices = file.readlines()[-1]
-    except Exception:
-        print("fix4melview_Standard_thr20.txt not found. Have you run s2_identify_components.py?")
-        return
-
-# Remove brackets
-    slices2remove = slices.split(",")
-    slices2remove = slices2remove[1:-1]
-# Join into comma separated string
-    slices2remove = ','.join(slices2remove)
-# put quotes around slices to be removed
-    slices2remove = '"' + slices2remove + '"'
-# create file name for output image
-    filename = [i,sprl,'denoised']
-# move into the subject's Prestats folder
-    os.chdir(os.path.join(directory, i, sprl))
-# create file path for output image
-
-    if not os.path.exists(clean_img):
-        print("Destination path for clean image doesnt exist: {}. Cannot proceed".format(clean_img))
-        sys.exit(1)
-    else:
-        clean_img = os.path.join(clean_img, '.'.join(filename))
+        components = read_flagged(csv)
+    except (IOError, OSError, IndexError):
+        return(i, sprl, 'failed', "{} not found. Have you run s2_identify_components.py?".format(csv))
+    except ValueError:
+        return(i, sprl, 'failed', "could not read the components to remove from the last line of {}".format(csv))
+
+    return(remove_components(components, clean_img, directory, i, sprl, stage, backend, mem_budget))
 
-    if (slices2remove != '""'):
-        # call fsl_regfilt to perform the component regression
-        call(["fsl_regfilt", "-i", "filtered_func_data", "-o", clean_img, "-d", "filtered_func_data.ica/melodic_mix", "-f", slices2remove])
-    elif (slices2remove == '""'):
-        clean_img = clean_img + ".nii.gz"
-        call(["cp", "filtered_func_data.nii.gz", clean_img])
+# regress components (numbered from 1) out of the filtered_func_data of one run. Returns (i, sprl, status, detail): 'cleaned' with the components removed, 'copied' with how the unchanged image was staged when there was nothing to remove, or 'failed' with the reason
+def remove_components(components, clean_img, directory, i, sprl, stage='copy', backend='fsl', mem_budget=None):
 
-def main(directory, clean_img, output):
+    rundir = os.path.abspath(os.path.join(directory, i, sprl))
 
-    list = os.listdir(directory)
+    if not os.path.isdir(clean_img):
+        return(i, sprl, 'failed', "Destination path for clean image doesnt exist: {}".format(clean_img))
 
-    for i in list:
-        if os.path.isdir(os.path.join(directory, i, 'sprlIN')) == True:
-            # name of file containing list of components to remove
-            csvfilenameSPRLIN = 'fix4melview_Standard_thr20.txt'
-            csvfilenameSPRLOUT = 'fix4melview_Standard_thr20.txt'
+    # file path for the output image
+    output = os.path.join(os.path.abspath(clean_img), '.'.join([i, sprl, 'denoised']))
+    data = os.path.join(rundir, "filtered_func_data")
+    mix = os.path.join(rundir, "filtered_func_data.ica", "melodic_mix")
 
-        # file path to list of components to remove
-            if output is not directory:
-                outputcsvSPRLIN = os.path.join(output, csvfilenameSPRLIN)
-                outputcsvSPRLOUT = os.path.join(output, csvfilenameSPRLOUT)
+    try:
+        if not components:
+            return(i, sprl, 'copied', staging.stage_file(data + ".nii.gz", output + ".nii.gz", stage))
+
+        # an earlier run with nothing to remove may have staged the output as a link to filtered_func_data. Writing the cleaned image through that link would overwrite the source data, so any existing output is removed first
+        for ext in [".nii.gz", ".nii"]:
+            if os.path.lexists(output + ext):
+                os.remove(output + ext)
+
+        if backend == 'numpy':
+            # regress the components out in this process, as fsl_regfilt would
+            regress.regfilt(data + ".nii.gz", mix, components, output + ".nii.gz", mem_budget)
+        else:
+            # call fsl_regfilt to perform the component regression
+            returncode = call(["fsl_regfilt", "-i", data, "-o", output, "-d", mix, "-f", ','.join(map(str, components))])
+            if returncode != 0:
+                return(i, sprl, 'failed', "fsl_regfilt failed with exit status {}".format(returncode))
+    except Exception as e:
+        return(i, sprl, 'failed', "{}: {}".format(type(e).__name__, e))
+
+    return(i, sprl, 'cleaned', components)
+
+# regfilt with its arguments in one tuple, for the worker pool
+def clean_run(job):
+    return(regfilt(*job))
+
+def main(directory, clean_img, output, stage='copy', backend='fsl', mem_budget=None, jobs=1):
+
+    # name of file containing list of components to remove
+    csvfilename = 'fix4melview_Standard_thr20.txt'
+
+    list_subs = sorted(i for i in os.listdir(directory) if os.path.isdir(os.path.join(directory, i, 'sprlIN')))
+
+    pending = []
+    for i in list_subs:
+        for sprl in ["sprlIN", "sprlOUT"]:
+            # file path to list of components to remove
+            if output != directory:
+                outputcsv = os.path.join(output, csvfilename)
             else:
-                outputcsvSPRLIN = os.path.join(directory, i, 'sprlIN', csvfilenameSPRLIN)
-                outputcsvSPRLOUT = os.path.join(directory, i, 'sprlOUT', csvfilenameSPRLOUT)
+                outputcsv = os.path.join(directory, i, sprl, csvfilename)
+            pending.append((outputcsv, clean_img, directory, i, sprl, stage, backend, mem_budget))
 
-            # call regfilt function to regress out components
-            regfilt(outputcsvSPRLIN, clean_img, directory, i, "sprlIN")
-            regfilt(outputcsvSPRLOUT, clean_img, directory, i, "sprlOUT")
+    # clean the runs, in a pool of worker processes if requested. Results are reported in work list order
+    if jobs > 1 and len(pending) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(pending)))
+        finished = pool.imap(clean_run, pending)
+    else:
+        pool = None
+        finished = (clean_run(job) for job in pending)
+
+    cleaned, copied, failures = [], [], []
+    try:
+        for i, sprl, status, detail in finished:
+            run = '/'.join([i, sprl])
+            if status == 'cleaned':
+                print("Removed components from {}, {}: [{}]".format(i, sprl, ','.join(map(str, detail))))
+                cleaned.append(run)
+            elif status == 'copied':
+                print("No components to remove from {}, {}: filtered_func_data staged ({})".format(i, sprl, detail))
+                copied.append(run)
+            else:
+                print("Failed {}, {}: {}".format(i, sprl, detail))
+                failures.append(run)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print("{} runs cleaned, {} runs copied, {} runs failed".format(len(cleaned), len(copied), len(failures)))
+    for run in failures:
+        print("  failed: {}".format(run))
+
+    return(failures)
 
 if __name__ == '__main__':
 
+    args = parser.parse_args()
+
     directory = args.directory
 
     if args.clean_img:
@@ -103,4 +160,4 @@ if __name__ == '__main__':
     else:
         output = args.directory
 
-    main(directory, clean_img, output)
+    main(directory, clean_img, output, args.stage, args.backend, args.memBudget, args.jobs)
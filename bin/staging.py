@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Puts a file at a new path, where possible without copying its contents.
+
+Used by s1_folder_setup.py to stage the split spirals in the experiment folder
+and by s3_remove_flagged_components.py for runs with no components to remove,
+whose cleaned image is filtered_func_data unchanged. The modes are:
+
+    copy        copy the contents (shutil.copy), as before
+    hardlink    a second name for the same file. Both names must be on the same
+                filesystem, and the file must not be edited in place afterwards
+    symlink     a link to the absolute path of the source, which must stay where
+                it is
+    reflink     a copy on write clone (linux FICLONE, e.g. btrfs, xfs), which
+                shares the data until either file is changed
+    auto        reflink if the filesystem supports it, otherwise hardlink
+
+A link that cannot be made (different filesystems, no reflink support, ...)
+falls back to an ordinary copy, so staging never fails for that reason.
+"""
+
+import errno
+import os, shutil, sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MODES = ['copy', 'hardlink', 'symlink', 'reflink', 'auto']
+
+# linux ioctl cloning the extents of one file into another, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def reflink(source, dest):
+
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are only supported on linux", dest)
+
+    with open(source, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(source, dest)
+
+def hardlink(source, dest):
+    os.link(source, dest)
+
+def symlink(source, dest):
+    os.symlink(os.path.abspath(source), dest)
+
+LINKS = {'hardlink': [('hardlink', hardlink)],
+         'symlink': [('symlink', symlink)],
+         'reflink': [('reflink', reflink)],
+         'auto': [('reflink', reflink), ('hardlink', hardlink)]}
+
+# put source at dest (or in dest, if it is a folder) using mode, replacing any file already there. Returns how the file was staged: one of the modes, or 'existing' if dest already is source
+def stage_file(source, dest, mode='copy'):
+
+    if mode not in MODES:
+        raise ValueError("staging mode must be one of {}, got {}".format(', '.join(MODES), mode))
+
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(source))
+
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        return('existing')
+
+    # links are made under a temporary name and renamed over dest, so an existing file is only replaced once the link is in place
+    partial = "{}.staging-{}".format(dest, os.getpid())
+    for method, link in LINKS.get(mode, []):
+        if os.path.lexists(partial):
+            os.remove(partial)
+        try:
+            link(source, partial)
+        except (IOError, OSError):
+            if os.path.lexists(partial):
+                os.remove(partial)
+            continue
+        os.rename(partial, dest)
+        return(method)
+
+    shutil.copy(source, dest)
+    return('copy')
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Generates a synthetic study of MELODIC outputs, for testing and benchmarking FeenICS without real data.
+
+Usage:
+    synthetic_study.py [options] <directory>
+
+Arguments:
+    <directory>         experiment directory to create. Subject folders s01, s02, ... are written in it
+
+Options:
+    --subjects          number of subjects. Default is 2
+    --shape             matrix size and number of slices, XxYxZ. Default is 64x64x20
+    --comps             number of components per run. Default is 30
+    --volumes           number of volumes (rows of melodic_mix). Default is 100
+    --artifact          fraction of components with spiral artifact. Default is 0.3
+    --seed              random seed. The same options and seed always give the same data. Default is 0
+
+For each subject and sprlIN/sprlOUT run, writes filtered_func_data.nii.gz and filtered_func_data.ica/melodic_IC.nii.gz and
+melodic_mix, laid out as s1_folder_setup.py and MELODIC leave them. Signal components are smooth blobs, whose power is at low
+frequencies. Artifact components are spirals, cos(2 pi f r + m theta), at mid frequencies (f of 0.22 to 0.32 cycles per pixel)
+in about half of their slices, and only a faint blob in the others. The components given artifact are listed, counting from 1, in
+feenics_synthetic.csv in <directory>.
+"""
+
+import argparse
+import os
+import numpy as np
+import nibabel as nib
+
+parser = argparse.ArgumentParser(description="Generate a synthetic study of MELODIC outputs with spiral artifact components")
+parser.add_argument("--subjects", type=int, default=2, help="number of subjects. Default is 2.")
+parser.add_argument("--shape", default="64x64x20", help="matrix size and number of slices as XxYxZ. Default is 64x64x20.")
+parser.add_argument("--comps", type=int, default=30, help="number of components per run. Default is 30.")
+parser.add_argument("--volumes", type=int, default=100, help="number of volumes. Default is 100.")
+parser.add_argument("--artifact", type=float, default=0.3, help="fraction of components with spiral artifact. Default is 0.3.")
+parser.add_argument("--seed", type=int, default=0, help="random seed. Default is 0.")
+parser.add_argument("directory", type=str, help="experiment directory to create")
+
+# smooth blob of the given width (in pixels) centred near the middle of an x by y slice
+def blob(xx, yy, rng, width):
+
+    x, y = xx.shape
+    cx = x/2. + rng.randn()*x/12.
+    cy = y/2. + rng.randn()*y/12.
+    return(np.exp(-((xx - cx)**2 + (yy - cy)**2) / (2*width**2)))
+
+# spiral with m arms at f cycles per pixel, centred near the middle of the slice, fading out towards the edge
+def spiral(xx, yy, rng):
+
+    x, y = xx.shape
+    dx = xx - x/2. - rng.randn()*2
+    dy = yy - y/2. - rng.randn()*2
+    r = np.sqrt(dx**2 + dy**2)
+    theta = np.arctan2(dy, dx)
+    f = rng.uniform(0.22, 0.32)
+    m = rng.randint(1, 5)
+    return(np.cos(2*np.pi*f*r + m*theta + rng.rand()*2*np.pi) * np.exp(-(r / (0.4*min(x, y)))**2))
+
+# (x, y, z, comps) float32 component maps and the (0 based) components given artifact
+def component_maps(shape, comps, artifact, rng):
+
+    x, y, z = shape
+    xx, yy = np.meshgrid(np.arange(x), np.arange(y), indexing='ij')
+    noisy = np.sort(rng.permutation(comps)[:int(round(comps*artifact))])
+
+    maps = np.empty((x, y, z, comps), dtype=np.float32)
+    for comp in range(comps):
+        for zslice in range(z):
+            if comp in noisy:
+                image = 3*spiral(xx, yy, rng) if rng.rand() < 0.5 else 0.1*blob(xx, yy, rng, x/10.)
+            else:
+                image = (2 + 3*rng.rand())*blob(xx, yy, rng, x/12. + rng.rand()*x/8.)
+            maps[:, :, zslice, comp] = image + 0.3*rng.randn(x, y)
+
+    return(maps, noisy)
+
+# (volumes, comps) component time courses: smoothed random walks, normalised to unit variance
+def mixing_matrix(volumes, comps, rng):
+
+    mix = np.cumsum(rng.randn(volumes, comps), axis=0)
+    kernel = np.ones(5) / 5.
+    mix = np.array([np.convolve(mix[:, comp], kernel, mode='same') for comp in range(comps)]).T
+    mix -= mix.mean(axis=0)
+    return(mix / mix.std(axis=0))
+
+# write the melodic outputs and filtered_func_data of one run folder. Returns the artifact components
+def make_run(rundir, shape, comps, volumes, artifact, rng):
+
+    maps, noisy = component_maps(shape, comps, artifact, rng)
+    mix = mixing_matrix(volumes, comps, rng)
+
+    icadir = os.path.join(rundir, 'filtered_func_data.ica')
+    if not os.path.isdir(icadir):
+        os.makedirs(icadir)
+    nib.save(nib.Nifti1Image(maps, np.eye(4)), os.path.join(icadir, 'melodic_IC.nii.gz'))
+    np.savetxt(os.path.join(icadir, 'melodic_mix'), mix, fmt='%.6e', delimiter='  ')
+
+    # the data the components were "found" in: a baseline, the components mixed by their time courses and some noise
+    voxels = maps.reshape((-1, comps), order='F')
+    data = 100. + np.dot(voxels, mix.T) + rng.randn(voxels.shape[0], volumes)
+    data = data.astype(np.float32).reshape(tuple(shape) + (volumes,), order='F')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(rundir, 'filtered_func_data.nii.gz'))
+
+    return(noisy)
+
+def main(directory, subjects=2, shape=(64, 64, 20), comps=30, volumes=100, artifact=0.3, seed=0):
+
+    rng = np.random.RandomState(seed)
+    rows = []
+    for subject in range(1, subjects + 1):
+        for sprl in ['sprlIN', 'sprlOUT']:
+            i = 's{:02d}'.format(subject)
+            noisy = make_run(os.path.join(directory, i, sprl), shape, comps, volumes, artifact, rng)
+            rows.append('{},{},"[{}]"'.format(i, sprl, ','.join(str(comp + 1) for comp in noisy)))
+
+    with open(os.path.join(directory, 'feenics_synthetic.csv'), 'w') as f:
+        f.write("subject,sprl,artifact\n")
+        for row in rows:
+            f.write(row + '\n')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    shape = tuple(int(n) for n in args.shape.split('x'))
+    main(args.directory, args.subjects, shape, args.comps, args.volumes, args.artifact, args.seed)